@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+#
+# Repeated runs of the perf workloads with summary statistics, so that a
+# regression can be told apart from noise.
+#
+#   ./benchmark.py python python3                  # all workloads
+#   ./benchmark.py -w perf1 -w fib -n 20 python
+#   ./benchmark.py --json new.json --compare old.json python
+#
+# Each workload is run once or more to warm up (file system, .pyc and
+# load-file caches) and then --runs times. A run's sample is perf3's
+# iterations, the total of the fib timings, or for perf1 and perf2 the
+# time of their load-file as measured around it by a wrapper script, in
+# time-ns where the implementation has it and time-ms otherwise (the
+# scripts' own "Elapsed time" is in whole milliseconds, too coarse for a
+# few percent of perf1). startup is the wall clock time of the process.
+# The report gives the median with a 95% confidence interval for it, the
+# 95th percentile and the spread; --compare marks a change only when the
+# two intervals do not overlap.
+#
+# --run-prefix is put in front of each run, e.g. make "bench^IMPL" passes
+# the env or docker prefix of the implementation's MODE.
+
+from __future__ import print_function
+import os, sys, re, json, math, time, platform, shlex, tempfile
+import argparse
+from subprocess import Popen, PIPE, STDOUT
+
+clock = getattr(time, 'perf_counter', time.time)
+
+IMPLS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'impls')
+
+def elapsed_ms(out):
+    return float(re.findall(r'Benchmark time: ([\d.]+) nsecs', out)[-1]) / 1e6
+
+def iterations(out):
+    return float(re.findall(r'iters over \d+ seconds: (\d+)', out)[-1])
+
+def fib_total(out):
+    times = re.findall(r'[\[(]([\d ]*)[\])]\s*$', out)[-1]
+    return float(sum(int(t) for t in times.split()))
+
+# load-file of a script between two readings of the finest clock the
+# implementation has
+TIMED = '''(def! bench-clock (try* time-ns (catch* e (fn* [] (* 1000000 (time-ms))))))
+(def! bench-start (bench-clock))
+(load-file "%s")
+(println "Benchmark time:" (- (bench-clock) bench-start) "nsecs")
+'''
+
+# name -> (script and arguments, parse output, unit, whether lower is
+# better); a script in a tuple is run through TIMED
+WORKLOADS = {
+    'perf1':   ([('../tests/perf1.mal',)], elapsed_ms, 'ms', True),
+    'perf2':   ([('../tests/perf2.mal',)], elapsed_ms, 'ms', True),
+    'perf3':   (['../tests/perf3.mal'], iterations, 'iters', False),
+    'fib':     (['../tests/fib.mal', '20', '5'], fib_total, 'ms', True),
+    'startup': (['../tests/print_argv.mal'], None, 's', True),
+}
+ORDER = ['startup', 'perf1', 'perf2', 'fib', 'perf3']
+
+# Statistics
+
+def median(xs):
+    return percentile(xs, 50)
+
+# linear interpolation between the closest ranks
+def percentile(xs, p):
+    xs = sorted(xs)
+    k = (len(xs) - 1) * p / 100.0
+    lo = int(math.floor(k))
+    hi = min(lo + 1, len(xs) - 1)
+    return xs[lo] + (xs[hi] - xs[lo]) * (k - lo)
+
+def stdev(xs):
+    if len(xs) < 2: return 0.0
+    m = sum(xs) / float(len(xs))
+    return math.sqrt(sum((x - m) ** 2 for x in xs) / (len(xs) - 1))
+
+def _binom_cdf(k, n):
+    return sum(math.factorial(n) // (math.factorial(i) * math.factorial(n - i))
+               for i in range(k + 1)) / 2.0 ** n
+
+# Distribution free interval for the median: sorted samples j and n-1-j,
+# which cover it with probability 1 - 2 P(B(n, 1/2) < j), for the largest j
+# that still gives the confidence. With fewer than 6 runs that is the range.
+def median_ci(xs, confidence=0.95):
+    xs = sorted(xs)
+    n, j = len(xs), 0
+    while j + 1 <= (n - 1) // 2 and 1 - 2 * _binom_cdf(j, n) >= confidence:
+        j += 1
+    return xs[j], xs[n - 1 - j]
+
+def summarize(samples):
+    return {'median': median(samples), 'p95': percentile(samples, 95),
+            'ci95': list(median_ci(samples)), 'min': min(samples),
+            'max': max(samples), 'stdev': stdev(samples)}
+
+# Running
+
+# The wrapper goes in impls/tests, which docker runs see as well
+def timed_script(script):
+    fd, path = tempfile.mkstemp(prefix='.bench-', suffix='.mal',
+                                dir=os.path.join(IMPLS_DIR, 'tests'))
+    with os.fdopen(fd, 'w') as f: f.write(TIMED % script)
+    return path
+
+# with a prefix the run keeps the terminal as stdin, for docker's -it
+def run_once(impl, argv, env, prefix):
+    start = clock()
+    p = Popen(prefix + ['../%s/run' % impl] + argv,
+              cwd=os.path.join(IMPLS_DIR, impl), stdin=None if prefix else PIPE,
+              stdout=PIPE, stderr=STDOUT, env=env)
+    out = p.communicate()[0].decode('utf-8', 'replace')
+    wall = clock() - start
+    if p.returncode != 0:
+        last = (out.strip().splitlines() or [''])[-1]
+        raise Exception('exit status %d: %s' % (p.returncode, last))
+    return out, wall
+
+def bench(impl, name, args, env, log):
+    argv, parse, unit, lower = WORKLOADS[name]
+    result = {'impl': impl, 'workload': name, 'unit': unit,
+              'lower_is_better': lower, 'samples': [], 'wall': []}
+    prefix = shlex.split(args.run_prefix)
+    wrapper = None
+    if type(argv[0]) == tuple:
+        wrapper = timed_script(argv[0][0])
+        argv = ['../tests/' + os.path.basename(wrapper)] + argv[1:]
+    try:
+        for i in range(args.warmup): run_once(impl, argv, env, prefix)
+        for i in range(args.runs):
+            out, wall = run_once(impl, argv, env, prefix)
+            result['wall'].append(wall)
+            result['samples'].append(parse(out) if parse else wall)
+            log('.')
+    except Exception as e:
+        result['error'] = str(e) or repr(e)
+        log(' error: %s\n' % result['error'])
+        return result
+    finally:
+        if wrapper: os.remove(wrapper)
+    result.update(summarize(result['samples']))
+    log('\n')
+    return result
+
+# Reporting
+
+def fmt(x, unit):
+    if unit == 's': return '%.3f' % x
+    if x < 10: return '%.2f' % x
+    return '%.1f' % x if x < 100 else '%.0f' % x
+
+def report(results):
+    lines = ['%-10s %-8s %-6s %10s %21s %10s %8s' % (
+        'impl', 'workload', 'unit', 'median', '95% CI', 'p95', 'stdev%')]
+    for r in results:
+        if 'error' in r:
+            lines.append('%-10s %-8s  %s' % (r['impl'], r['workload'], r['error']))
+            continue
+        u = r['unit']
+        lines.append('%-10s %-8s %-6s %10s %21s %10s %8.1f' % (
+            r['impl'], r['workload'], u, fmt(r['median'], u),
+            '[%s, %s]' % (fmt(r['ci95'][0], u), fmt(r['ci95'][1], u)),
+            fmt(r['p95'], u), 100.0 * r['stdev'] / (r['median'] or 1)))
+    return '\n'.join(lines)
+
+# Change from old to new: 'faster'/'slower' when the confidence intervals
+# of the medians do not overlap, else '~'
+def verdict(old, new):
+    if old['ci95'][1] < new['ci95'][0]:   higher = True
+    elif new['ci95'][1] < old['ci95'][0]: higher = False
+    else:                                 return '~'
+    return 'slower' if higher == new['lower_is_better'] else 'faster'
+
+def compare(old_results, results):
+    old = dict(((r['impl'], r['workload']), r) for r in old_results
+               if 'error' not in r)
+    lines = ['%-10s %-8s %10s %10s %8s  %s' % (
+        'impl', 'workload', 'old', 'new', 'change', '')]
+    for r in results:
+        o = old.get((r['impl'], r['workload']))
+        if o is None or 'error' in r: continue
+        u = r['unit']
+        change = 100.0 * (r['median'] - o['median']) / (o['median'] or 1)
+        lines.append('%-10s %-8s %10s %10s %+7.1f%%  %s' % (
+            r['impl'], r['workload'], fmt(o['median'], u), fmt(r['median'], u),
+            change, verdict(o, r)))
+    return '\n'.join(lines)
+
+def git_revision():
+    try:
+        p = Popen(['git', 'rev-parse', '--short', 'HEAD'], stdout=PIPE,
+                  stderr=PIPE, cwd=IMPLS_DIR)
+        return p.communicate()[0].decode().strip() or None
+    except OSError:
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(
+            description="Benchmark Mal implementations with repeated runs")
+    parser.add_argument('impls', nargs='*', default=['python'],
+            help="implementations to run (directories under impls/)")
+    parser.add_argument('-w', '--workload', action='append',
+            choices=ORDER, help="workload to run (repeatable; default all)")
+    parser.add_argument('-n', '--runs', default=10, type=int,
+            help="measured runs per workload")
+    parser.add_argument('--warmup', default=1, type=int,
+            help="unmeasured runs before the measured ones")
+    parser.add_argument('--env', action='append', default=[],
+            metavar='VAR=VALUE', help="set in the environment of the runs")
+    parser.add_argument('--run-prefix', default='', metavar='COMMAND',
+            help="command (env or docker run ...) to run each run with")
+    parser.add_argument('--json', metavar='FILE',
+            help="write the samples and statistics to FILE")
+    parser.add_argument('--compare', metavar='FILE',
+            help="compare with the results in a previous --json FILE")
+    args = parser.parse_args()
+    if args.runs < 1: parser.error("--runs must be at least 1")
+
+    env = dict(os.environ)
+    for setting in args.env:
+        var, _, value = setting.partition('=')
+        env[var] = value
+
+    def log(s):
+        sys.stderr.write(s)
+        sys.stderr.flush()
+
+    results = []
+    for impl in args.impls:
+        for name in args.workload or ORDER:
+            log('%s %s ' % (impl, name))
+            results.append(bench(impl, name, args, env, log))
+
+    print(report(results))
+    if args.compare:
+        with open(args.compare) as f: old = json.load(f)
+        print()
+        print(compare(old['results'], results))
+    if args.json:
+        data = {'revision': git_revision(),
+                'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'host': platform.node(), 'platform': platform.platform(),
+                'runs': args.runs, 'warmup': args.warmup,
+                'env': args.env, 'results': results}
+        with open(args.json, 'w') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+if __name__ == '__main__':
+    main()
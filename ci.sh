@@ -26,7 +26,7 @@ mode_val=${!mode_var}
 
 MAKE="make ${mode_val:+${mode_var}=${mode_val}}"
 
-log_prefix="${ACTION}${REGRESS:+-regress}-${IMPL}${mode_val:+-${mode_val}}${MAL_IMPL:+-${MAL_IMPL}}"
+log_prefix="${ACTION}${REGRESS:+-regress}-${IMPL}${mode_val:+-${mode_val}}${MAL_EVAL:+-${MAL_EVAL}}${MAL_IMPL:+-${MAL_IMPL}}"
 TEST_OPTS="${TEST_OPTS} --debug-file ../../${log_prefix}.debug"
 
 # Log everything below this point:
@@ -46,6 +46,7 @@ echo "ACTION: ${ACTION}"
 echo "IMPL: ${IMPL}"
 echo "BUILD_IMPL: ${BUILD_IMPL}"
 echo "MAL_IMPL: ${MAL_IMPL}"
+echo "MAL_EVAL: ${MAL_EVAL}"
 echo "TEST_OPTS: ${TEST_OPTS}"
 
 # If NO_DOCKER is blank then launch use a docker image, otherwise use
@@ -54,7 +55,7 @@ if [ -z "${NO_DOCKER}" ]; then
     img_impl=$(echo "${MAL_IMPL:-${IMPL}}" | tr '[:upper:]' '[:lower:]')
     # We could just use make DOCKERIZE=1 instead but that does add
     # non-trivial startup overhead for each step.
-    MAKE="docker run -i -u $(id -u) -v `pwd`:/mal kanaka/mal-test-${img_impl%%-mal} ${MAKE}"
+    MAKE="docker run -i -u $(id -u) -v `pwd`:/mal ${MAL_EVAL:+-e MAL_EVAL=${MAL_EVAL}} kanaka/mal-test-${img_impl%%-mal} ${MAKE}"
 fi
 
 case "${ACTION}" in
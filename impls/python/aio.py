@@ -0,0 +1,184 @@
+# Concurrent I/O on an asyncio event loop.
+#
+#   (def! c (async-slurp "a.txt"))  ; a channel that gets the file's text
+#   (go (println (count (<! c))))   ; runs body concurrently; returns a
+#                                   ; channel that gets its value
+#   (<! (async-sh "ls"))            ; the output of a shell command
+#   (sleep 100)                     ; pauses the calling go block
+#   (def! ch (chan 10))             ; channel with a buffer of 10; (chan)
+#   (>! ch 1) (<! ch) (close! ch)   ; is unbuffered; <! is nil once closed
+#
+# The loop runs on a thread of its own, started on first use, and does
+# the reads, pipes, timers and channel operations. Mal code stays
+# synchronous: a go block runs its thunk on its own thread, which waits
+# on the loop in <!, >! and sleep, so hundreds of operations can be in
+# flight at once. Only one thread runs python at a time: this is for
+# waiting on I/O, not for using more cores (see parallel.py). An error in
+# a go block or an async operation is thrown again by the <! that takes
+# from its channel. slurp and the rest of core.py are unchanged.
+
+import subprocess
+import sys
+import threading
+from collections import deque
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+import mal_types as types
+
+_loop = None
+_lock = threading.Lock()
+
+def _get_loop():
+    global _loop
+    with _lock:
+        if _loop is None:
+            if asyncio is None: raise types.MalException("asyncio is not available")
+            _loop = asyncio.new_event_loop()
+            t = threading.Thread(target=_loop.run_forever, name='mal-aio')
+            t.daemon = True
+            t.start()
+    return _loop
+
+# Run coroutine on the loop and wait for its value
+def _wait(coro):
+    return asyncio.run_coroutine_threadsafe(coro, _get_loop()).result()
+
+# what a channel carries for an error, thrown by the <! that takes it
+class _Error(object):
+    def __init__(self, exc): self.exc = exc
+
+# Only used on the loop's thread
+class Chan(object):
+    def __init__(self, size=0):
+        self.size = size
+        self.items = deque()
+        self.takers = deque()    # futures waiting for an item
+        self.putters = deque()   # (future, item) waiting for room
+        self.closed = False
+
+    async def put(self, val):
+        if self.closed: return False
+        while self.takers:
+            f = self.takers.popleft()
+            if not f.done():
+                f.set_result(val)
+                return True
+        if len(self.items) < self.size:
+            self.items.append(val)
+            return True
+        f = _loop.create_future()
+        self.putters.append((f, val))
+        return await f
+
+    # the next waiting put, moving its item along
+    def _next_putter(self):
+        while self.putters:
+            f, val = self.putters.popleft()
+            if not f.done():
+                f.set_result(True)
+                return val
+        return None
+
+    async def take(self):
+        if self.items:
+            val = self.items.popleft()
+            waiting = self._next_putter()
+            if waiting is not None: self.items.append(waiting)
+            return val
+        val = self._next_putter()
+        if val is not None or self.closed: return val
+        f = _loop.create_future()
+        self.takers.append(f)
+        return await f
+
+    async def close(self):
+        self.closed = True
+        for f in self.takers:
+            if not f.done(): f.set_result(None)
+        for f, val in self.putters:
+            if not f.done(): f.set_result(False)
+        self.takers.clear(), self.putters.clear()
+
+def chan(size=0): return Chan(size)
+def chan_Q(exp): return type(exp) == Chan
+
+def put(ch, val):
+    if val is None: raise types.MalException(">!: can't put nil on a channel")
+    return _wait(ch.put(val))
+
+def take(ch):
+    val = _wait(ch.take())
+    if type(val) == _Error: raise val.exc
+    return val
+
+def close(ch):
+    _wait(ch.close())
+    return None
+
+def sleep(ms):
+    _wait(asyncio.sleep(ms / 1000.0))
+    return None
+
+# A channel that gets the value of coro (or its error) and is then closed
+def _deliver(coro):
+    ch = Chan(1)
+    async def run():
+        try:
+            val = await coro
+        except Exception as e:
+            val = _Error(e)
+        if val is not None: await ch.put(val)
+        await ch.close()
+    asyncio.run_coroutine_threadsafe(run(), _get_loop())
+    return ch
+
+def async_slurp(path):
+    def read():
+        with open(path) as f: return f.read()
+    return _deliver(_get_loop().run_in_executor(None, read))
+
+# the loop runs on a thread of its own, and asyncio only starts
+# subprocesses from such a loop from python 3.8 on: before that the
+# command runs on the loop's executor
+def async_sh(cmd):
+    if sys.version_info < (3, 8):
+        def run_sync():
+            proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
+            return proc.communicate()[0].decode('utf-8', 'replace')
+        return _deliver(_get_loop().run_in_executor(None, run_sync))
+    async def run():
+        proc = await asyncio.create_subprocess_shell(
+            cmd, stdout=asyncio.subprocess.PIPE)
+        out, _ = await proc.communicate()
+        return out.decode('utf-8', 'replace')
+    _get_loop()
+    return _deliver(run())
+
+# (go body...) is (go* (fn* () body...))
+def go(f):
+    ch = Chan(1)
+    def run():
+        try:
+            val = f()
+        except Exception as e:
+            val = _Error(e)
+        if val is not None: _wait(ch.put(val))
+        _wait(ch.close())
+    t = threading.Thread(target=run, name='mal-go')
+    t.daemon = True
+    t.start()
+    return ch
+
+ns = {
+    'chan': chan,
+    'chan?': chan_Q,
+    '>!': put,
+    '<!': take,
+    'close!': close,
+    'sleep': sleep,
+    'go*': go,
+    'async-slurp': async_slurp,
+    'async-sh': async_sh,
+}
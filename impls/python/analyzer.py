@@ -0,0 +1,458 @@
+import weakref
+import profiler
+import transpiler
+import mal_types as types
+from mal_types import List, Vector, Hash_Map
+
+# Closure-compiling evaluator: each form is analyzed once into a tree of
+# nested python closures taking an environment. Special forms, symbol
+# lookups and calls are decided at analysis time instead of on every
+# EVAL. Enabled in stepA_mal with MAL_EVAL=analyze.
+#
+# Locals bound by fn*, let* and catch* are resolved at analysis time to a
+# (depth, slot) pair. At runtime a frame is a python list whose slot 0 is
+# the enclosing frame, so a local reference is `depth` indexings of slot
+# 0 followed by one index. let* and catch* allocate their slots in the
+# enclosing fn* frame, so depth only grows with fn* nesting. Globals stay
+# in the dict-backed Env passed to EVAL.
+
+# set by stepA_mal
+quasiquote = None
+
+# Tail calls return a TailCall instead of growing the python stack; run
+# trampolines them.
+class TailCall(object):
+    __slots__ = ('node', 'env', 'fn')
+    def __init__(self, node, env, fn):
+        self.node = node
+        self.env = env
+        self.fn = fn
+
+def run(node, env):
+    ret = node(env)
+    if type(ret) is TailCall and profiler.enabled:
+        return profiler.run(ret, TailCall, env)
+    while type(ret) is TailCall:
+        ret = ret.node(ret.env)
+    return ret
+
+def EVAL(ast, env):
+    layout = Layout()
+    node = analyze(ast, env, Scope(None, layout), True)
+    layout.frozen = True
+    frame = [env] + [None] * (layout.size - 1)
+    return run(node, frame)
+
+def macroexpand(ast, env):
+    while (types._list_Q(ast) and
+           types._symbol_Q(ast[0]) and
+           env.find(ast[0]) and
+           hasattr(env.get(ast[0]), '_ismacro_')):
+        ast = expand_macro(env.get(ast[0]), ast[1:])
+    return ast
+
+def expand_macro(mac, args):
+    if profiler.enabled: return profiler.expand(mac, args)
+    return mac(*args)
+
+# Static scopes
+
+# Slot allocation for one runtime frame. Once the owning form is fully
+# analyzed the layout is frozen: slots added afterwards (by forms analyzed
+# on first execution) may be missing from frames that already exist.
+class Layout(object):
+    __slots__ = ('size', 'frozen')
+    def __init__(self):
+        self.size = 1
+        self.frozen = False
+    def alloc(self):
+        self.size += 1
+        return self.size - 1
+
+# A lexical block: the names bound by one fn*, let* or catch*. While a
+# let* binding is analyzed, the names not assigned yet are pending: like
+# in the tree walker they resolve outwards, except from inside a fn*.
+class Scope(object):
+    __slots__ = ('names', 'outer', 'layout', 'pending')
+    def __init__(self, outer, layout, names=None, pending=()):
+        self.names = {} if names is None else names
+        self.outer = outer
+        self.layout = layout
+        self.pending = pending
+    def bind(self, sym):
+        self.names[sym] = self.layout.alloc()
+        return self.names[sym]
+
+def resolve(scope, sym):
+    depth = 0
+    while scope:
+        if sym in scope.names and (depth or sym not in scope.pending):
+            return depth, scope.names[sym]
+        if scope.outer and scope.outer.layout is not scope.layout:
+            depth += 1
+        scope = scope.outer
+    return None
+
+def load_local(depth, slot):
+    if depth == 0:   return lambda env: env[slot]
+    elif depth == 1: return lambda env: env[0][slot]
+    elif depth == 2: return lambda env: env[0][0][slot]
+    def node(env):
+        for _ in range(depth): env = env[0]
+        return env[slot]
+    return node
+
+# Inline cache for one global reference, valid while env.version is
+# unchanged
+def load_global(env, sym):
+    cache = [None, -1]
+    def node(_):
+        if cache[1] == env.version: return cache[0]
+        cache[0] = env.get(sym)
+        cache[1] = env.version
+        return cache[0]
+    return node
+
+def store_local(scope, slot):
+    if not scope.layout.frozen:
+        def store(env, value):
+            env[slot] = value
+    else:
+        def store(env, value):
+            if slot >= len(env): env.extend([None] * (slot + 1 - len(env)))
+            env[slot] = value
+    return store
+
+# analyze
+#   env:   global environment, used for globals and to expand macros
+#   scope: innermost lexical block
+#   tail:  whether the form is in tail position
+def analyze(ast, env, scope, tail):
+    if types._symbol_Q(ast):
+        local = resolve(scope, ast)
+        if local: return load_local(*local)
+        return load_global(env, ast)
+    elif types._list_Q(ast):
+        if len(ast) == 0: return lambda _: ast
+        a0 = ast[0]
+        if types._symbol_Q(a0):
+            if a0 in special_forms:
+                return special_forms[a0](ast, env, scope, tail)
+            if not resolve(scope, a0) and a0 not in defining:
+                if not env.find(a0):
+                    return analyze_deferred(ast, env, scope, tail)
+                if hasattr(env.get(a0), '_ismacro_'):
+                    return analyze_macro(ast, env, scope, tail)
+        return analyze_apply(ast, env, scope, tail)
+    elif types._vector_Q(ast):
+        nodes = [analyze(a, env, scope, False) for a in ast]
+        return lambda env: Vector([n(env) for n in nodes])
+    elif types._hash_map_Q(ast):
+        items = [(k, analyze(v, env, scope, False)) for k, v in ast.items()]
+        return lambda env: Hash_Map((k, n(env)) for k, n in items)
+    else:
+        return lambda _: ast  # primitive value, return unchanged
+
+# Globals whose def! value is being analyzed: calls to them are usually
+# recursion, not a macro defined later.
+defining = []
+
+# The head symbol is not bound yet, so it may name a macro defined later
+# (e.g. further down in the same load-file). Analyze on first execution.
+def analyze_deferred(ast, env, scope, tail):
+    cell = []
+    def node(frame):
+        if not cell:
+            if env.find(ast[0]): cell.append(analyze(ast, env, scope, tail))
+            else:                cell.append(analyze_apply(ast, env, scope, tail))
+        return cell[0](frame)
+    return node
+
+# Macro calls are expanded at analysis time. The expansion is redone if
+# the macro is redefined, and on every execution for impure macros.
+def analyze_macro(ast, env, scope, tail):
+    def expand(mac):
+        if hasattr(mac, '_impure_'):
+            return analyze_impure(ast, env, scope, tail)
+        elif hasattr(mac, '_ismacro_'):
+            # cached on the call site like the tree walker does, for
+            # transpiler.py
+            ast.__expansion__ = (mac, expand_macro(mac, ast[1:]))
+            return analyze(ast.__expansion__[1], env, scope, tail)
+        else:
+            return analyze_apply(ast, env, scope, tail)
+    mac = env.get(ast[0])
+    state = [mac, expand(mac), env.version]
+    def node(frame):
+        if state[2] != env.version:
+            state[2] = env.version
+            mac = env.find(ast[0]) and env.get(ast[0])
+            if mac is not state[0]:
+                state[0], state[1] = mac, expand(mac)
+        return state[1](frame)
+    return node
+
+# An impure macro's expansion is analyzed into a frame of its own, so
+# re-analysis does not grow the enclosing frame.
+def analyze_impure(ast, env, scope, tail):
+    def node(frame):
+        layout = Layout()
+        inner = Scope(scope if scope.outer else None, layout)
+        expanded = analyze(macroexpand(ast, env), env, inner, tail)
+        layout.frozen = True
+        return expanded([frame] + [None] * (layout.size - 1))
+    return node
+
+def analyze_apply(ast, env, scope, tail):
+    fnode = analyze(ast[0], env, scope, False)
+    anodes = [analyze(a, env, scope, False) for a in ast[1:]]
+    # the args are evaluated in the node itself rather than in a helper,
+    # which would add a python frame to each level of non-tail recursion.
+    # Only the fns analyze_fn made are trampolined: the body of any other
+    # fn with an __ast__ (a tree walker fn) is not a node.
+    if tail:
+        if len(anodes) == 1:
+            a1 = anodes[0]
+            def node(env):
+                f = fnode(env)
+                if hasattr(getattr(f, '__ast__', None), '_node_'):
+                    return TailCall(f.__ast__, f.__gen_env__((a1(env),)), f)
+                return f(a1(env))
+        elif len(anodes) == 2:
+            a1, a2 = anodes
+            def node(env):
+                f = fnode(env)
+                if hasattr(getattr(f, '__ast__', None), '_node_'):
+                    return TailCall(f.__ast__, f.__gen_env__((a1(env), a2(env))), f)
+                return f(a1(env), a2(env))
+        else:
+            def node(env):
+                f = fnode(env)
+                args = [a(env) for a in anodes]
+                if hasattr(getattr(f, '__ast__', None), '_node_'):
+                    return TailCall(f.__ast__, f.__gen_env__(args), f)
+                return f(*args)
+    elif len(anodes) == 0:
+        node = lambda env: fnode(env)()
+    elif len(anodes) == 1:
+        a1 = anodes[0]
+        node = lambda env: fnode(env)(a1(env))
+    elif len(anodes) == 2:
+        a1, a2 = anodes
+        node = lambda env: fnode(env)(a1(env), a2(env))
+    else:
+        node = lambda env: fnode(env)(*[a(env) for a in anodes])
+    return node
+
+# special forms
+
+def analyze_def(ast, env, scope, tail):
+    a1 = ast[1]
+    if scope.outer is None:
+        defining.append(a1)
+        try:
+            vnode = analyze(ast[2], env, scope, False)
+        finally:
+            defining.pop()
+        def node(frame):
+            value = vnode(frame)
+            if transpiler.threshold: transpiler.watch(value, a1, env)
+            return env.set(a1, profiler.name(value, a1))
+        return node
+    vnode = analyze(ast[2], env, scope, False)
+    # like the tree walker, def! inside fn*/let* binds in the innermost block
+    slot = scope.names.get(a1) or scope.bind(a1)
+    store = store_local(scope, slot)
+    def node(frame):
+        value = vnode(frame)
+        store(frame, value)
+        return value
+    return node
+
+def analyze_let(ast, env, scope, tail):
+    a1 = ast[1]
+    scope = Scope(scope, scope.layout)
+    for sym in a1[::2]:
+        if sym not in scope.names: scope.bind(sym)
+    bindings = []
+    for i in range(0, len(a1), 2):
+        pending = frozenset(a1[i::2]) - frozenset(a1[:i:2])
+        init_scope = Scope(scope.outer, scope.layout, scope.names, pending)
+        vnode = analyze(a1[i+1], env, init_scope, False)
+        bindings.append((store_local(scope, scope.names[a1[i]]), vnode))
+    body = analyze(ast[2], env, scope, tail)
+    def node(env):
+        for store, vnode in bindings: store(env, vnode(env))
+        return body(env)
+    return node
+
+def analyze_quote(ast, env, scope, tail):
+    a1 = ast[1]
+    return lambda _: a1
+
+def analyze_quasiquoteexpand(ast, env, scope, tail):
+    a1 = quasiquote(ast[1])
+    return lambda _: a1
+
+def analyze_quasiquote(ast, env, scope, tail):
+    return analyze(quasiquote(ast[1]), env, scope, tail)
+
+def analyze_defmacro(ast, env, scope, tail):
+    a1, vnode = ast[1], analyze(ast[2], env, scope, False)
+    def node(frame):
+        return env.set(a1, profiler.name(types._macro(vnode(frame)), a1))
+    return node
+
+def analyze_macroexpand(ast, env, scope, tail):
+    a1 = ast[1]
+    return lambda _: macroexpand(a1, env)
+
+def analyze_py_exec(ast, env, scope, tail):
+    code = compile(ast[1], '', 'single')
+    def node(_):
+        exec(code, globals())
+        return None
+    return node
+
+def analyze_py_eval(ast, env, scope, tail):
+    code = compile(ast[1], '', 'eval')
+    return lambda _: types.py_to_mal(eval(code))
+
+def analyze_py_call(ast, env, scope, tail):
+    code = compile(ast[1], '', 'eval')
+    anodes = [analyze(a, env, scope, False) for a in ast[2:]]
+    return lambda env: eval(code)(*[a(env) for a in anodes])
+
+def analyze_try(ast, env, scope, tail):
+    if len(ast) < 3:
+        return analyze(ast[1], env, scope, tail)
+    a1, a2 = ast[1], ast[2]
+    if a2[0] != "catch*":
+        return analyze(a1, env, scope, tail)
+    body = analyze(a1, env, scope, False)
+    scope = Scope(scope, scope.layout)
+    store = store_local(scope, scope.bind(a2[1]))
+    handler = analyze(a2[2], env, scope, tail)
+    def node(env):
+        err = None
+        try:
+            return body(env)
+        except types.MalException as exc:
+            err = exc.object
+        except Exception as exc:
+            err = exc.args[0]
+        store(env, err)
+        return handler(env)
+    return node
+
+def analyze_do(ast, env, scope, tail):
+    if len(ast) == 1: return lambda _: None
+    nodes = [analyze(a, env, scope, False) for a in ast[1:-1]]
+    last = analyze(ast[-1], env, scope, tail)
+    def node(env):
+        for n in nodes: n(env)
+        return last(env)
+    return node
+
+def analyze_if(ast, env, scope, tail):
+    cnode = analyze(ast[1], env, scope, False)
+    then = analyze(ast[2], env, scope, tail)
+    if len(ast) > 3: other = analyze(ast[3], env, scope, tail)
+    else:            other = lambda _: None
+    def node(env):
+        cond = cnode(env)
+        if cond is None or cond is False:
+            return other(env)
+        return then(env)
+    return node
+
+# The fn* form, global env and enclosing scope of each analyzed fn body,
+# so that image.py can analyze the closures it restores again
+sources = weakref.WeakKeyDictionary()
+
+def analyze_fn(ast, env, scope, tail):
+    params = ast[1]
+    layout = Layout()
+    outer, scope = scope, Scope(scope, layout)
+    nfixed, variadic = len(params), False
+    for i, p in enumerate(params):
+        if p == "&":
+            nfixed, variadic = i, True
+            scope.bind(params[i+1])
+            break
+        scope.bind(p)
+    body = analyze(ast[2], env, scope, True)
+    body._node_ = True
+    layout.frozen = True
+    sources[body] = (ast, env, outer)
+    frames = Frames(layout, nfixed, variadic)
+    return lambda frame: types._function(run, frames, body, frame, params)
+
+# Passed to _function in place of Env: builder makes the function that
+# builds the frame of a call from its args, specialized on the number of
+# fixed parameters like Env.builder. Slots a frozen layout gets later are
+# added by the stores that use them.
+class Frames(object):
+    def __init__(self, layout, nfixed, variadic):
+        self.layout = layout
+        self.nfixed = nfixed
+        self.variadic = variadic
+
+    def builder(self, outer, binds):
+        n, variadic = self.nfixed, self.variadic
+        pad = [None] * (self.layout.size - 1 - n - variadic)
+        if variadic:
+            def build(args):
+                frame = [outer]
+                frame.extend([args[i] for i in range(n)])
+                frame.append(List(args[n:]))
+                if pad: frame.extend(pad)
+                return frame
+        elif n == 0:
+            def build(args):
+                frame = [outer]
+                if pad: frame.extend(pad)
+                return frame
+        elif n == 1:
+            def build(args):
+                frame = [outer, args[0]]
+                if pad: frame.extend(pad)
+                return frame
+        elif n == 2:
+            def build(args):
+                frame = [outer, args[0], args[1]]
+                if pad: frame.extend(pad)
+                return frame
+        elif n == 3:
+            def build(args):
+                frame = [outer, args[0], args[1], args[2]]
+                if pad: frame.extend(pad)
+                return frame
+        elif n == 4:
+            def build(args):
+                frame = [outer, args[0], args[1], args[2], args[3]]
+                if pad: frame.extend(pad)
+                return frame
+        else:
+            def build(args):
+                frame = [outer]
+                frame.extend([args[i] for i in range(n)])
+                if pad: frame.extend(pad)
+                return frame
+        return build
+
+special_forms = {
+    'def!':             analyze_def,
+    'let*':             analyze_let,
+    'quote':            analyze_quote,
+    'quasiquoteexpand': analyze_quasiquoteexpand,
+    'quasiquote':       analyze_quasiquote,
+    'defmacro!':        analyze_defmacro,
+    'macroexpand':      analyze_macroexpand,
+    'py!*':             analyze_py_exec,
+    'py*':              analyze_py_eval,
+    '.':                analyze_py_call,
+    'try*':             analyze_try,
+    'do':               analyze_do,
+    'if':               analyze_if,
+    'fn*':              analyze_fn}
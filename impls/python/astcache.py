@@ -0,0 +1,102 @@
+# On-disk cache of the forms read by load-file, like __pycache__.
+#
+# read_file(path) returns the same form as
+#   (read-string (str "(do " (slurp path) "\nnil)"))
+# but keeps it in __malcache__/<name>.<python tag>.ast next to the source.
+# A cache file is a header (magic, source mtime in ns, size and sha1)
+# followed by the form in marshal format. It is used when the mtime and
+# size match, or else when the sha1 of the source matches. Set
+# MAL_NO_AST_CACHE to read without the cache.
+
+import hashlib, marshal, os, struct, sys
+import mal_types as types
+from mal_types import List, Vector, Hash_Map, Symbol, Keyword
+import reader
+
+MAGIC = b'MAL\x03'
+HEADER = struct.Struct('<4sqq20s')
+TAG = 'py%d%d' % sys.version_info[:2]
+CACHE_DIR = '__malcache__'
+
+# marshal handles ints, strings, None and booleans; the other forms
+# become (tag, items) tuples. List items are stored last to first, the
+# order List keeps them in.
+_LIST, _VECTOR, _MAP, _SYMBOL, _KEYWORD = range(5)
+
+def encode(ast):
+    t = type(ast)
+    if t == List:      return (_LIST, tuple(encode(x) for x in reversed(ast)))
+    elif t == Vector:  return (_VECTOR, tuple(encode(x) for x in ast))
+    elif t == Hash_Map:
+        return (_MAP, tuple(encode(x) for kv in ast.items() for x in kv))
+    elif t == Symbol:  return (_SYMBOL, str(ast))
+    elif t == Keyword: return (_KEYWORD, ast[1:])
+    else:              return ast
+
+def decode(obj):
+    tag, items = obj
+    if tag == _SYMBOL:    return types._symbol(items)
+    elif tag == _KEYWORD: return types._keyword(items)
+    arr = [decode(x) if type(x) == tuple else x for x in items]
+    if tag == _LIST:     return List._view(arr, len(arr))
+    elif tag == _VECTOR: return Vector(arr)
+    else:                return types._hash_map(*arr)
+
+def cache_path(path):
+    dirname, name = os.path.split(os.path.abspath(path))
+    return os.path.join(dirname, CACHE_DIR, '%s.%s.ast' % (name, TAG))
+
+def _stat(path):
+    st = os.stat(path)
+    return getattr(st, 'st_mtime_ns', int(st.st_mtime * 1e9)), st.st_size
+
+def _read_source(path):
+    with open(path) as f: text = f.read()
+    return text, hashlib.sha1(text.encode('utf-8')).digest()
+
+def _parse(text):
+    return reader.read_str("(do " + text + "\nnil)")
+
+def read_file(path):
+    if os.environ.get('MAL_NO_AST_CACHE'):
+        with open(path) as f: return _parse(f.read())
+    mtime, size = _stat(path)
+    cpath = cache_path(path)
+    text = digest = None
+    try:
+        with open(cpath, 'rb') as f:
+            magic, c_mtime, c_size, c_digest = HEADER.unpack(f.read(HEADER.size))
+            if magic == MAGIC:
+                if (c_mtime, c_size) != (mtime, size):
+                    text, digest = _read_source(path)
+                if digest is None or digest == c_digest:
+                    ast = decode(marshal.loads(f.read()))
+                    if digest is not None: _touch(cpath, mtime, size, digest)
+                    return ast
+    except (IOError, OSError, EOFError, ValueError, TypeError, struct.error):
+        pass
+    if text is None: text, digest = _read_source(path)
+    ast = _parse(text)
+    write(cpath, mtime, size, digest, ast)
+    return ast
+
+# The source was touched but not changed: record its new mtime and size
+def _touch(cpath, mtime, size, digest):
+    try:
+        with open(cpath, 'r+b') as f: f.write(HEADER.pack(MAGIC, mtime, size, digest))
+    except (IOError, OSError):
+        pass
+
+# Best effort: an unwritable directory just means no cache
+def write(cpath, mtime, size, digest, ast):
+    tmp = '%s.%d.tmp' % (cpath, os.getpid())
+    try:
+        if not os.path.isdir(os.path.dirname(cpath)):
+            os.makedirs(os.path.dirname(cpath))
+        with open(tmp, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, mtime, size, digest))
+            f.write(marshal.dumps(encode(ast)))
+        os.rename(tmp, cpath)
+    except (IOError, OSError):
+        try: os.remove(tmp)
+        except OSError: pass
@@ -0,0 +1,64 @@
+# Variable access cost versus nesting depth.
+#
+#   python bench/env_depth.py
+#
+# For a variable bound DEPTH blocks above its reference, compare the tree
+# walker's Env.get (a dict test per level of the outer chain) with the
+# analyzer's (depth, slot) lookups, through nested let* and nested fn*.
+#
+# Only let* is flat: its slots are in the frame of the enclosing fn*. A
+# local of an enclosing fn* is still reached by following slot 0 once per
+# fn* in between, so the fn* column grows with depth, if more slowly than
+# Env.get (depths 0 to 2 have a specialized node).
+
+import os, sys, timeit
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import mal_types as types
+from env import Env
+import analyzer, core, reader
+
+REFS = 100
+DEPTHS = [1, 2, 4, 8, 16, 32, 64]
+
+repl_env = Env()
+for k, v in core.ns.items(): repl_env.set(types._symbol(k), v)
+
+def per_ref(stmt, number):
+    best = min(timeit.repeat(stmt, number=number, repeat=5))
+    return best / number / REFS * 1e9
+
+def env_get(depth):
+    env = Env(repl_env)
+    env.set(types._symbol('v0'), 0)
+    for i in range(1, depth):
+        env = Env(env)
+        env.set(types._symbol('v%d' % i), i)
+    sym = types._symbol('v0')
+    get = env.get
+    return per_ref(lambda: [get(sym) for _ in range(REFS)], 2000)
+
+def nested(depth, binder):
+    body = '(do %s)' % ' '.join(['v0'] * REFS)
+    for i in reversed(range(depth)):
+        body = binder(i, body)
+    return body
+
+def analyzed_let(depth):
+    src = '(fn* [] %s)' % nested(depth, lambda i, b: '(let* [v%d %d] %s)' % (i, i, b))
+    f = analyzer.EVAL(reader.read_str(src), repl_env)
+    return per_ref(f, 2000)
+
+def analyzed_fn(depth):
+    src = nested(depth, lambda i, b: '(fn* [v%d] %s)' % (i, b))
+    f = analyzer.EVAL(reader.read_str(src), repl_env)
+    for i in range(depth - 1): f = f(i)
+    return per_ref(lambda: f(depth - 1), 2000)
+
+if __name__ == '__main__':
+    print('%6s %14s %14s %14s' % ('depth', 'Env.get', 'let* slots', 'fn* slots'))
+    print('%6s %14s %14s %14s' % ('', '(ns/ref)', '(ns/ref)', '(ns/ref)'))
+    for depth in DEPTHS:
+        print('%6d %14.1f %14.1f %14.1f' % (
+            depth, env_get(depth), analyzed_let(depth), analyzed_fn(depth)))
+    print('fn* slots walk one frame per enclosing fn*: O(depth), unlike let*')
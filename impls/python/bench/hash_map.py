@@ -0,0 +1,52 @@
+# Building hash-maps one assoc at a time, as (reduce assoc {} ...) does.
+#
+#   python bench/hash_map.py [SIZE ...]
+#
+# Compares core.assoc on the HAMT-backed Hash_Map, and assoc! on a
+# transient of it, with the previous copy-on-assoc dict, which is only run
+# up to COPY_LIMIT entries because it is quadratic.
+
+import copy, os, sys, time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import mal_types as types
+import core
+
+SIZES = [10000, 100000, 1000000]
+COPY_LIMIT = 20000
+
+def copy_assoc(src_hm, *key_vals):
+    hm = copy.copy(src_hm)
+    for i in range(0,len(key_vals),2): hm[key_vals[i]] = key_vals[i+1]
+    return hm
+
+def build(assoc, empty, n):
+    keys = [types._keyword('k%d' % i) for i in range(n)]
+    start = time.perf_counter()
+    hm = empty
+    for i, k in enumerate(keys): hm = assoc(hm, k, i)
+    elapsed = time.perf_counter() - start
+    assert len(hm) == n
+    return hm, keys, elapsed
+
+def lookup(hm, keys):
+    start = time.perf_counter()
+    for k in keys: core.get(hm, k)
+    return time.perf_counter() - start
+
+if __name__ == '__main__':
+    sizes = [int(a) for a in sys.argv[1:]] or SIZES
+    print('%9s %12s %12s %16s %14s %12s' % ('entries', 'hamt build', 'hamt get',
+                                            'transient build', 'dict+copy build',
+                                            'dict get'))
+    for n in sizes:
+        hm, keys, t_build = build(core.assoc, types._hash_map(), n)
+        t_get = lookup(hm, keys)
+        _, _, t_transient = build(core.assoc_BANG, core.transient(types._hash_map()), n)
+        if n <= COPY_LIMIT:
+            d, _, t_copy = build(copy_assoc, {}, n)
+            copy_cols = '%13.3fs %11.3fs' % (t_copy, lookup(d, keys))
+        else:
+            copy_cols = '%14s %12s' % ('-', '-')
+        print('%9d %11.3fs %11.3fs %15.3fs %s' % (n, t_build, t_get, t_transient,
+                                                  copy_cols))
@@ -0,0 +1,52 @@
+# Folding over a list with first/rest, as the recursive reduce in
+# impls/lib/reducers.mal does, and building it back up with cons.
+#
+#   python bench/list.py [SIZE ...]
+#
+# Compares core.first/rest/cons on the shared-array List with the
+# previous copying ones, which are only run up to COPY_LIMIT elements
+# because they are quadratic.
+
+import os, sys, time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import mal_types as types
+import core
+
+SIZES = [10000, 100000]
+COPY_LIMIT = 20000
+
+def copy_rest(lst): return list(lst[1:])
+def copy_cons(x, seq): return [x] + list(seq)
+def copy_first(lst): return lst[0] if lst else None
+
+def fold(first, rest, lst):
+    start = time.perf_counter()
+    acc = 0
+    while len(lst):
+        acc += first(lst)
+        lst = rest(lst)
+    elapsed = time.perf_counter() - start
+    return acc, elapsed
+
+def build(cons, empty, n):
+    start = time.perf_counter()
+    lst = empty
+    for i in range(n): lst = cons(i, lst)
+    return lst, time.perf_counter() - start
+
+if __name__ == '__main__':
+    sizes = [int(a) for a in sys.argv[1:]] or SIZES
+    print('%9s %12s %12s %14s %12s' % ('elements', 'list cons', 'list fold',
+                                       'copy cons', 'copy fold'))
+    for n in sizes:
+        lst, t_build = build(core.cons, types._list(), n)
+        total, t_fold = fold(core.first, core.rest, lst)
+        assert total == n * (n - 1) // 2
+        if n <= COPY_LIMIT:
+            old, t_copy = build(copy_cons, [], n)
+            copy_cols = '%13.3fs %11.3fs' % (
+                t_copy, fold(copy_first, copy_rest, old)[1])
+        else:
+            copy_cols = '%14s %12s' % ('-', '-')
+        print('%9d %11.3fs %11.3fs %s' % (n, t_build, t_fold, copy_cols))
@@ -0,0 +1,63 @@
+# Reading source as load-file does: the whole file as one (do ...) form.
+#
+#   python bench/reader.py [MEGABYTES]
+#
+# Reads every .mal file under impls/ (test inputs that do not parse as a
+# whole file are read a line at a time, as the test runner sends them),
+# then a generated file of MEGABYTES (default 10) of nested forms.
+
+import glob, os, random, sys, time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import reader
+
+IMPLS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..')
+
+def corpus():
+    texts = []
+    for path in sorted(glob.glob(os.path.join(IMPLS, '**', '*.mal'), recursive=True)):
+        with open(path) as f: text = f.read()
+        try:
+            reader.read_str('(do ' + text + '\nnil)')
+            texts.append('(do ' + text + '\nnil)')
+        except Exception:
+            texts.extend(text.split('\n'))
+    return texts
+
+ATOMS = ['42', '-7', 'nil', 'true', 'false', ':key', 'sym', 'a-longer-symbol?',
+         '"a string"', '"esc\\"aped\\n"', '+', 'x']
+
+def form(rnd, depth):
+    if depth > 4 or rnd.random() < 0.4: return rnd.choice(ATOMS)
+    n = rnd.randint(0, 6)
+    items = ' '.join(form(rnd, depth + 1) for _ in range(n))
+    kind = rnd.random()
+    if kind < 0.6:   return '(' + items + ')'
+    elif kind < 0.8: return '[' + items + ']'
+    elif kind < 0.9: return "'" + '(' + items + ')'
+    else:            return '{' + ' '.join(rnd.choice(ATOMS) + ' ' + form(rnd, depth + 1)
+                                          for _ in range(n // 2)) + '}'
+
+def synthetic(megabytes):
+    rnd, parts, size = random.Random(42), [], 0
+    while size < megabytes * 1000000:
+        part = form(rnd, 0) + ' ; comment\n'
+        parts.append(part)
+        size += len(part)
+    return '(do ' + ''.join(parts) + '\nnil)'
+
+# corpus lines include deliberately bad input, which counts like any other
+def read_all(texts):
+    start = time.perf_counter()
+    for text in texts:
+        try: reader.read_str(text)
+        except Exception: pass
+    return time.perf_counter() - start
+
+if __name__ == '__main__':
+    megabytes = float(sys.argv[1]) if len(sys.argv) > 1 else 10
+    for name, texts in [('corpus', corpus()), ('synthetic', [synthetic(megabytes)])]:
+        size = sum(len(t) for t in texts) / 1e6
+        if name == 'synthetic': reader.read_str(texts[0])  # must parse
+        elapsed = read_all(texts)
+        print('%-10s %8.2f MB %8.3fs %8.2f MB/s' % (name, size, elapsed, size / elapsed))
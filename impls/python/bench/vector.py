@@ -0,0 +1,45 @@
+# Growing a vector one conj at a time, as (reduce conj [] ...) does.
+#
+#   python bench/vector.py [SIZE ...]
+#
+# Compares core.conj on the trie-backed Vector with the previous
+# copy-on-conj list, which is only run up to COPY_LIMIT elements because
+# it is quadratic. nth reads every element of the result.
+
+import os, sys, time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import mal_types as types
+import core
+
+SIZES = [10000, 100000, 1000000]
+COPY_LIMIT = 20000
+
+def copy_conj(lst, *args): return lst + list(args)
+
+def build(conj, empty, n):
+    start = time.perf_counter()
+    vec = empty
+    for i in range(n): vec = conj(vec, i)
+    elapsed = time.perf_counter() - start
+    assert len(vec) == n
+    return vec, elapsed
+
+def read(vec):
+    start = time.perf_counter()
+    for i in range(len(vec)): core.nth(vec, i)
+    return time.perf_counter() - start
+
+if __name__ == '__main__':
+    sizes = [int(a) for a in sys.argv[1:]] or SIZES
+    print('%9s %12s %12s %14s %12s' % ('elements', 'trie conj', 'trie nth',
+                                       'list+copy conj', 'list nth'))
+    for n in sizes:
+        vec, t_build = build(core.conj, types._vector(), n)
+        t_read = read(vec)
+        if n <= COPY_LIMIT:
+            lst, t_copy = build(copy_conj, [], n)
+            copy_cols = '%13.3fs %11.3fs' % (t_copy, read(lst))
+        else:
+            copy_cols = '%14s %12s' % ('-', '-')
+        print('%9d %11.3fs %11.3fs %s' % (n, t_build, t_read, copy_cols))
@@ -1,12 +1,32 @@
-import copy, time
-from itertools import chain
+import time, itertools, gc, math, operator, functools
+from itertools import chain, islice
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
 
 import mal_types as types
 from mal_types import MalException, List, Vector
 import mal_readline
 import reader
+import astcache
+import profiler
+import parallel
+import threads
+import transpiler
 import printer
 
+# python 2 differences
+if hasattr(itertools, 'imap'):
+    _map, _range = itertools.imap, xrange
+else:
+    _map, _range = map, range
+
+if hasattr(time, 'perf_counter_ns'):
+    _time_ns = time.perf_counter_ns
+else:
+    _time_ns = lambda: int(getattr(time, 'perf_counter', time.time)() * 1e9)
+
 # Errors/Exceptions
 def throw(obj): raise MalException(obj)
 
@@ -27,17 +47,66 @@ def println(*args):
     return None
 
 
+# Numeric functions
+# Variadic like clojure's; the two argument case stays a single operation
+_none = object()
+
+def add(a=0, b=0, *more):
+    if more: return sum(more, a + b)
+    return a + b
+
+def sub(a, b=_none, *more):
+    if b is _none: return -a
+    if more: return a - b - sum(more)
+    return a - b
+
+def mul(a=1, b=1, *more):
+    if more: return functools.reduce(operator.mul, more, a * b)
+    return a * b
+
+def div(a, b=_none, *more):
+    if b is _none: return int(1 / a)
+    a = int(a / b)
+    for b in more: a = int(a / b)
+    return a
+
+def _compare(op):
+    def compare(a, b=_none, *more):
+        if b is _none: return True
+        if more:
+            xs = (a, b) + more
+            return all(_map(op, xs, xs[1:]))
+        return op(a, b)
+    return compare
+
+if hasattr(math, 'prod'):
+    _prod = math.prod
+else:
+    _prod = lambda xs: functools.reduce(operator.mul, xs, 1)
+
+def sum_(coll): return sum(_iter(coll))
+def product(coll): return _prod(_iter(coll))
+
+# (min 3 1 2) or (min coll)
+def _extreme(pick):
+    def extreme(x, *more):
+        if more: return pick((x,) + more)
+        if x is None or types._sequential_Q(x): return pick(_iter(x))
+        return x
+    return extreme
+
+
 # Hash map functions
 def assoc(src_hm, *key_vals):
-    hm = copy.copy(src_hm)
-    for i in range(0,len(key_vals),2): hm[key_vals[i]] = key_vals[i+1]
-    return hm
+    if types._vector_Q(src_hm):
+        vec = src_hm
+        for i in range(0,len(key_vals),2):
+            if not 0 <= key_vals[i] <= len(vec): throw("assoc: index out of range")
+            vec = vec.assoc(key_vals[i], key_vals[i+1])
+        return vec
+    return src_hm.assoc(*key_vals)
 
-def dissoc(src_hm, *keys):
-    hm = copy.copy(src_hm)
-    for key in keys:
-        hm.pop(key, None)
-    return hm
+def dissoc(src_hm, *keys): return src_hm.dissoc(*keys)
 
 def get(hm, key):
     if hm is not None:
@@ -55,38 +124,52 @@ def vals(hm): return types._list(*hm.values())
 # Sequence functions
 def coll_Q(coll): return sequential_Q(coll) or hash_map_Q(coll)
 
-def cons(x, seq): return List([x]) + List(seq)
+def cons(x, seq):
+    if types._list_Q(seq) or types._lazy_seq_Q(seq): return seq.cons(x)
+    return List(seq).cons(x)
 
 def concat(*lsts): return List(chain(*lsts))
 
 def nth(lst, idx):
+    if types._lazy_seq_Q(lst):
+        for x in islice(lst, idx, None): return x
+        throw("nth: index out of range")
     if idx < len(lst): return lst[idx]
     else: throw("nth: index out of range")
 
 def first(lst):
     if types._nil_Q(lst): return None
+    elif types._lazy_seq_Q(lst): return lst.first()
     else: return lst[0]
 
 def rest(lst):
     if types._nil_Q(lst): return List([])
-    else: return List(lst[1:])
+    elif types._list_Q(lst): return lst[1:]
+    elif types._lazy_seq_Q(lst): return lst.rest()
+    else: return List(lst)[1:]
 
-def empty_Q(lst): return len(lst) == 0
+def empty_Q(lst):
+    if types._lazy_seq_Q(lst): return lst.empty()
+    return len(lst) == 0
 
 def count(lst):
     if types._nil_Q(lst): return 0
     else: return len(lst)
 
-def apply(f, *args): return f(*(list(args[0:-1])+args[-1]))
+def apply(f, *args): return f(*(list(args[0:-1])+list(args[-1])))
 
-def mapf(f, lst): return List(map(f, lst))
+# lazy over a lazy seq, which may be infinite; a list otherwise, so that
+# f runs (and throws) within the call to map
+def mapf(f, lst):
+    if types._lazy_seq_Q(lst): return lazy_map(f, lst)
+    return List(map(f, lst))
 
 # retains metadata
 def conj(lst, *args):
-    if types._list_Q(lst): 
-        new_lst = List(list(reversed(list(args))) + lst)
-    else:
-        new_lst = Vector(lst + list(args))
+    if types._vector_Q(lst):
+        return lst.conj(*args)
+    new_lst = lst
+    for x in args: new_lst = new_lst.cons(x)
     if hasattr(lst, "__meta__"):
         new_lst.__meta__ = lst.__meta__
     return new_lst
@@ -94,6 +177,8 @@ def conj(lst, *args):
 def seq(obj):
     if types._list_Q(obj):
         return obj if len(obj) > 0 else None
+    elif types._lazy_seq_Q(obj):
+        return None if obj.empty() else obj
     elif types._vector_Q(obj):
         return List(obj) if len(obj) > 0 else None
     elif types._string_Q(obj):
@@ -102,6 +187,104 @@ def seq(obj):
         return None
     else: throw ("seq: called on non-sequence")
 
+# Lazy sequences
+# Each returns a LazySeq that pulls from its source as it is realized.
+def _iter(coll): return iter(() if coll is None else coll)
+
+def _truthy(x): return x is not None and x is not False
+
+def lazy_seq(f): return types.LazySeq(f)
+
+def lazy_range(*args):
+    if not args: return types._lazy_iter(itertools.count())
+    return types._lazy_iter(iter(_range(*args)))
+
+def take(n, coll): return types._lazy_iter(islice(_iter(coll), max(n, 0)))
+
+def drop(n, coll): return types._lazy_iter(islice(_iter(coll), max(n, 0), None))
+
+def lazy_filter(f, coll):
+    return types._lazy_iter(x for x in _items(coll) if _truthy(f(x)))
+
+def remove(f, coll):
+    return types._lazy_iter(x for x in _items(coll) if not _truthy(f(x)))
+
+def lazy_map(f, *colls):
+    return types._lazy_iter(_map(f, *[_iter(c) for c in colls]))
+
+def _iterate(f, x):
+    while True:
+        yield x
+        x = f(x)
+
+def iterate(f, x): return types._lazy_iter(_iterate(f, x))
+
+# Reducing functions
+# The items of coll, with the entries of a hash-map as [k v] vectors
+def _items(coll):
+    if types._hash_map_Q(coll): return (Vector(kv) for kv in coll.items())
+    return _iter(coll)
+
+def reduce_(f, *args):
+    if len(args) == 1:
+        it = iter(_items(args[0]))
+        for acc in it: break
+        else: return f()
+    else:
+        acc, it = args[0], _items(args[1])
+    for x in it:
+        acc = f(acc, x)
+        if type(acc) is types.Reduced: return acc.val
+    return acc
+
+def reduce_kv(f, acc, coll):
+    if types._hash_map_Q(coll): kvs = coll.items()
+    else:                       kvs = enumerate(_iter(coll))
+    for k, v in kvs:
+        acc = f(acc, k, v)
+        if type(acc) is types.Reduced: return acc.val
+    return acc
+
+def some(f, coll):
+    for x in _items(coll):
+        res = f(x)
+        if _truthy(res): return res
+    return None
+
+def every_Q(f, coll):
+    return all(_truthy(f(x)) for x in _items(coll))
+
+# Transient functions
+def transient(coll):
+    if types._vector_Q(coll):     return types.TransientVector(coll)
+    elif types._hash_map_Q(coll): return types.TransientHashMap(coll)
+    else: throw("transient: not a vector or hash-map")
+
+def _transient(name, coll, typ=types.Transient):
+    if not isinstance(coll, typ): throw("%s: not a transient %s" % (
+        name, "hash-map" if typ is types.TransientHashMap else "collection"))
+    return coll
+
+def conj_BANG(coll, *vals):
+    _transient('conj!', coll)
+    if type(coll) == types.TransientVector: return coll.conj(*vals)
+    for kv in vals: coll.assoc(kv[0], kv[1])
+    return coll
+
+def assoc_BANG(coll, *key_vals):
+    _transient('assoc!', coll)
+    if type(coll) == types.TransientHashMap: return coll.assoc(*key_vals)
+    for i in range(0, len(key_vals), 2):
+        if not 0 <= key_vals[i] <= len(coll): throw("assoc!: index out of range")
+        coll.assoc(key_vals[i], key_vals[i+1])
+    return coll
+
+def dissoc_BANG(coll, *keys):
+    return _transient('dissoc!', coll, types.TransientHashMap).dissoc(*keys)
+
+def persistent_BANG(coll):
+    return _transient('persistent!', coll).persistent()
+
 # Metadata functions
 def with_meta(obj, meta):
     new_obj = types._clone(obj)
@@ -113,13 +296,49 @@ def meta(obj):
 
 
 # Atoms functions
-def deref(atm):    return atm.val
-def reset_BANG(atm,val):
-    atm.val = val
-    return atm.val
+# deref of a future or promise may take a timeout in ms and the value to
+# return when it runs out
+def deref(atm, *timeout):
+    if type(atm) == types.Atom: return atm.val
+    return atm.deref(*timeout)
+def reset_BANG(atm,val): return atm.reset(val)
+def compare_and_set_BANG(atm,old,new): return atm.compare_and_set(old, new)
+# f runs again if another thread changed atm while it ran
 def swap_BANG(atm,f,*args):
-    atm.val = f(atm.val,*args)
-    return atm.val
+    while True:
+        old = atm.val
+        new = f(old,*args)
+        if atm.compare_and_set(old, new): return new
+
+# Measurement functions
+def _stats(**kw):
+    return types._hash_map(*chain(*((types._keyword(k.replace('_', '-')), v)
+                                    for k, v in kw.items())))
+
+def gc_stats():
+    gens = gc.get_stats() if hasattr(gc, 'get_stats') else []
+    return _stats(enabled=gc.isenabled(),
+                  counts=Vector(gc.get_count()),
+                  thresholds=Vector(gc.get_threshold()),
+                  collections=Vector(g['collections'] for g in gens),
+                  collected=Vector(g['collected'] for g in gens),
+                  uncollectable=Vector(g['uncollectable'] for g in gens))
+
+# Bytes allocated by python while tracing: current is what is still live,
+# peak the most live since tracing started (or the last reset)
+def alloc_stats():
+    if tracemalloc is None or not tracemalloc.is_tracing():
+        return _stats(tracing=False)
+    current, peak = tracemalloc.get_traced_memory()
+    return _stats(tracing=True, current=current, peak=peak)
+
+# (alloc-trace true) starts tracing afresh, (alloc-trace false) stops it;
+# :unsupported where python has no tracemalloc (python 2)
+def alloc_trace(on):
+    if tracemalloc is None: return types._keyword('unsupported')
+    if tracemalloc.is_tracing(): tracemalloc.stop()
+    if on: tracemalloc.start()
+    return None
 
 
 ns = { 
@@ -145,16 +364,31 @@ ns = {
         'println': println,
         'readline': lambda prompt: mal_readline.readline(prompt),
         'read-string': reader.read_str,
+        'read-file': astcache.read_file,
         'slurp': lambda file: open(file).read(),
-        '<':  lambda a,b: a<b,
-        '<=': lambda a,b: a<=b,
-        '>':  lambda a,b: a>b,
-        '>=': lambda a,b: a>=b,
-        '+':  lambda a,b: a+b,
-        '-':  lambda a,b: a-b,
-        '*':  lambda a,b: a*b,
-        '/':  lambda a,b: int(a/b),
+        '<':  _compare(operator.lt),
+        '<=': _compare(operator.le),
+        '>':  _compare(operator.gt),
+        '>=': _compare(operator.ge),
+        '+':  add,
+        '-':  sub,
+        '*':  mul,
+        '/':  div,
+        'sum': sum_,
+        'product': product,
+        'min': _extreme(min),
+        'max': _extreme(max),
         'time-ms': lambda : int(time.time() * 1000),
+        'time-ns': _time_ns,
+        'gc-stats': gc_stats,
+        'alloc-stats': alloc_stats,
+        'alloc-trace': alloc_trace,
+        'profile-start': lambda : profiler.start(),
+        'profile-stop': lambda : profiler.stop(),
+        'profile-report': lambda : profiler.report(),
+        'profile-collapsed': lambda : profiler.collapsed(),
+        'profile-print': lambda : profiler.print_report(),
+        'profile-write-collapsed': lambda path: profiler.write_collapsed(path),
 
         'list': types._list,
         'list?': types._list_Q,
@@ -180,8 +414,29 @@ ns = {
         'count': count,
         'apply': apply,
         'map': mapf,
+        'lazy-seq*': lazy_seq,
+        'range': lazy_range,
+        'take': take,
+        'drop': drop,
+        'filter': lazy_filter,
+        'lazy-map': lazy_map,
+        'remove': remove,
+        'iterate': iterate,
+
+        'reduce': reduce_,
+        'reduce-kv': reduce_kv,
+        'reduced': types._reduced,
+        'reduced?': types._reduced_Q,
+        'some': some,
+        'every?': every_Q,
 
         'conj': conj,
+        'transient': transient,
+        'transient?': types._transient_Q,
+        'conj!': conj_BANG,
+        'assoc!': assoc_BANG,
+        'dissoc!': dissoc_BANG,
+        'persistent!': persistent_BANG,
         'seq': seq,
 
         'with-meta': with_meta,
@@ -189,6 +444,21 @@ ns = {
         'atom': types._atom,
         'atom?': types._atom_Q,
         'deref': deref,
+
+        'compare-and-set!': compare_and_set_BANG,
+        'future-call': threads.future_call,
+        'promise': threads.promise,
+        'deliver': threads.deliver,
+        'future?': lambda x: type(x) in (threads.Future, parallel.Future),
+        'realized?': lambda x: x.realized(),
+
+        'pmap': parallel.pmap,
+        'pcalls': parallel.pcalls,
+        'pfuture-call': parallel.future_call,
+        'parallel-options': parallel.parallel_options,
+
+        'compile-fn': transpiler.compile_fn,
+        'compile-threshold': transpiler.compile_threshold,
         'reset!': reset_BANG,
         'swap!': swap_BANG}
 
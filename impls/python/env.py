@@ -1,6 +1,11 @@
 # Environment
+from mal_types import List
+
+class Env(object):
+    # bumped when set() rebinds an existing key (def!/defmacro! over a
+    # global), invalidating the analyzer's inline caches
+    version = 0
 
-class Env():
     def __init__(self, outer=None, binds=None, exprs=None):
         self.data = {}
         self.outer = outer or None
@@ -8,7 +13,7 @@ class Env():
         if binds:
             for i in range(len(binds)):
                 if binds[i] == "&":
-                    self.data[binds[i+1]] = exprs[i:]
+                    self.data[binds[i+1]] = List(exprs[i:])
                     break
                 else:
                     self.data[binds[i]] = exprs[i]
@@ -19,6 +24,7 @@ class Env():
         else:                return None
 
     def set(self, key, value):
+        if key in self.data: self.version += 1
         self.data[key] = value
         return value
 
@@ -26,3 +32,61 @@ class Env():
         env = self.find(key)
         if not env: raise Exception("'" + key + "' not found")
         return env.data[key]
+
+    # The function _function uses to make the env of each call of a fn from
+    # the call's args: binds is looked at once, when the fn is made, so
+    # calls do no "&" checks and only build the env and its dict
+    @classmethod
+    def builder(cls, outer, binds):
+        outer = outer or None
+        binds = list(binds)
+        rest = None
+        if "&" in binds:
+            i = binds.index("&")
+            binds, rest = binds[:i], binds[i+1]
+        new = cls.__new__
+        n = len(binds)
+        if n == 0:
+            def build(args):
+                env = new(cls)
+                env.outer, env.data = outer, {}
+                return env
+        elif n == 1:
+            b0, = binds
+            def build(args):
+                env = new(cls)
+                env.outer, env.data = outer, {b0: args[0]}
+                return env
+        elif n == 2:
+            b0, b1 = binds
+            def build(args):
+                env = new(cls)
+                env.outer, env.data = outer, {b0: args[0], b1: args[1]}
+                return env
+        elif n == 3:
+            b0, b1, b2 = binds
+            def build(args):
+                env = new(cls)
+                env.outer, env.data = outer, {b0: args[0], b1: args[1],
+                                              b2: args[2]}
+                return env
+        elif n == 4:
+            b0, b1, b2, b3 = binds
+            def build(args):
+                env = new(cls)
+                env.outer, env.data = outer, {b0: args[0], b1: args[1],
+                                              b2: args[2], b3: args[3]}
+                return env
+        else:
+            def build(args):
+                env = new(cls)
+                env.outer = outer
+                env.data = dict((b, args[i]) for i, b in enumerate(binds))
+                return env
+        if rest is None: return build
+        fixed = build
+        def build(args):
+            env = fixed(args)
+            env.data[rest] = List(args[n:])
+            return env
+        return build
@@ -0,0 +1,229 @@
+# Hash array mapped trie: the persistent storage behind Hash_Map.
+#
+# Nodes are never modified once built. assoc/without copy only the path
+# from the root to the changed entry (at most 7 nodes of up to 32
+# entries), so updates are O(log32 n) and share the rest of the trie.
+#
+# The exception is the nodes of a transient map: assoc_mut/without_mut
+# take an edit token and change nodes carrying that token in place,
+# copying (and tagging) the others the first time they are reached.
+
+BITS = 5
+MASK = (1 << BITS) - 1
+HASH_MASK = 0xffffffff
+
+# marks a slot of a BitmapNode that holds a child node instead of a key
+_NODE = object()
+
+if hasattr(int, 'bit_count'):
+    def _popcount(x): return x.bit_count()
+else:
+    def _popcount(x): return bin(x).count('1')
+
+def _hash(key): return hash(key) & HASH_MASK
+
+# Up to 32 entries, indexed by 5 bits of the key hash. array holds
+# key/value pairs: [k0, v0, k1, v1, ...], where a key of _NODE means the
+# value is a child node for the next 5 bits.
+class BitmapNode(object):
+    __slots__ = ('bitmap', 'array', 'edit')
+    def __init__(self, bitmap, array, edit=None):
+        self.bitmap = bitmap
+        self.array = array
+        self.edit = edit
+
+    def _editable(self, edit):
+        if self.edit is edit: return self
+        return BitmapNode(self.bitmap, self.array[:], edit)
+
+    def find(self, shift, h, key, notfound):
+        bit = 1 << ((h >> shift) & MASK)
+        if not self.bitmap & bit: return notfound
+        i = 2 * _popcount(self.bitmap & (bit - 1))
+        k = self.array[i]
+        if k is _NODE:
+            return self.array[i+1].find(shift + BITS, h, key, notfound)
+        if k is key or k == key: return self.array[i+1]
+        return notfound
+
+    # returns (node, added) where added is False if key was present
+    def assoc(self, shift, h, key, val):
+        bit = 1 << ((h >> shift) & MASK)
+        i = 2 * _popcount(self.bitmap & (bit - 1))
+        array = self.array
+        if not self.bitmap & bit:
+            return BitmapNode(self.bitmap | bit,
+                              array[:i] + [key, val] + array[i:]), True
+        k, v = array[i], array[i+1]
+        if k is _NODE:
+            child, added = v.assoc(shift + BITS, h, key, val)
+            if child is v: return self, False
+            new_array = array[:]
+            new_array[i+1] = child
+            return BitmapNode(self.bitmap, new_array), added
+        if k is key or k == key:
+            if v is val: return self, False
+            new_array = array[:]
+            new_array[i+1] = val
+            return BitmapNode(self.bitmap, new_array), False
+        new_array = array[:]
+        new_array[i] = _NODE
+        new_array[i+1] = _pair_node(shift + BITS, _hash(k), k, v, h, key, val)
+        return BitmapNode(self.bitmap, new_array), True
+
+    # returns the node without key, None if it would be empty
+    def without(self, shift, h, key):
+        bit = 1 << ((h >> shift) & MASK)
+        if not self.bitmap & bit: return self
+        i = 2 * _popcount(self.bitmap & (bit - 1))
+        array = self.array
+        k, v = array[i], array[i+1]
+        if k is _NODE:
+            child = v.without(shift + BITS, h, key)
+            if child is v: return self
+            if child is not None:
+                new_array = array[:]
+                new_array[i+1] = child
+                return BitmapNode(self.bitmap, new_array)
+        elif not (k is key or k == key):
+            return self
+        if self.bitmap == bit: return None
+        return BitmapNode(self.bitmap ^ bit, array[:i] + array[i+2:])
+
+    def assoc_mut(self, edit, shift, h, key, val):
+        bit = 1 << ((h >> shift) & MASK)
+        i = 2 * _popcount(self.bitmap & (bit - 1))
+        if not self.bitmap & bit:
+            node = self._editable(edit)
+            node.bitmap |= bit
+            node.array[i:i] = [key, val]
+            return node, True
+        k, v = self.array[i], self.array[i+1]
+        if k is _NODE:
+            child, added = v.assoc_mut(edit, shift + BITS, h, key, val)
+            if child is v: return self, added
+            node = self._editable(edit)
+            node.array[i+1] = child
+            return node, added
+        if k is key or k == key:
+            if v is val: return self, False
+            node = self._editable(edit)
+            node.array[i+1] = val
+            return node, False
+        node = self._editable(edit)
+        node.array[i] = _NODE
+        node.array[i+1] = _pair_node(shift + BITS, _hash(k), k, v, h, key, val)
+        return node, True
+
+    def without_mut(self, edit, shift, h, key):
+        bit = 1 << ((h >> shift) & MASK)
+        if not self.bitmap & bit: return self
+        i = 2 * _popcount(self.bitmap & (bit - 1))
+        k, v = self.array[i], self.array[i+1]
+        if k is _NODE:
+            child = v.without_mut(edit, shift + BITS, h, key)
+            if child is v: return self
+            if child is not None:
+                node = self._editable(edit)
+                node.array[i+1] = child
+                return node
+        elif not (k is key or k == key):
+            return self
+        if self.bitmap == bit: return None
+        node = self._editable(edit)
+        node.bitmap ^= bit
+        del node.array[i:i+2]
+        return node
+
+    def items(self):
+        array = self.array
+        for i in range(0, len(array), 2):
+            if array[i] is _NODE:
+                for item in array[i+1].items(): yield item
+            else:
+                yield array[i], array[i+1]
+
+# Keys whose 32 bit hashes are equal
+class CollisionNode(object):
+    __slots__ = ('hash', 'array')
+    def __init__(self, hash, array):
+        self.hash = hash
+        self.array = array
+
+    def _index(self, key):
+        array = self.array
+        for i in range(0, len(array), 2):
+            if array[i] is key or array[i] == key: return i
+        return -1
+
+    def find(self, shift, h, key, notfound):
+        i = self._index(key)
+        return notfound if i < 0 else self.array[i+1]
+
+    def assoc(self, shift, h, key, val):
+        if h != self.hash:
+            # push this node one level down next to the new key
+            node = BitmapNode(1 << ((self.hash >> shift) & MASK), [_NODE, self])
+            return node.assoc(shift, h, key, val)
+        i = self._index(key)
+        if i < 0:
+            return CollisionNode(h, self.array + [key, val]), True
+        if self.array[i+1] is val: return self, False
+        new_array = self.array[:]
+        new_array[i+1] = val
+        return CollisionNode(h, new_array), False
+
+    def without(self, shift, h, key):
+        i = self._index(key)
+        if i < 0: return self
+        if len(self.array) == 2: return None
+        return CollisionNode(h, self.array[:i] + self.array[i+2:])
+
+    # collisions are rare enough to always copy
+    def assoc_mut(self, edit, shift, h, key, val):
+        return self.assoc(shift, h, key, val)
+
+    def without_mut(self, edit, shift, h, key):
+        return self.without(shift, h, key)
+
+    def items(self):
+        array = self.array
+        for i in range(0, len(array), 2):
+            yield array[i], array[i+1]
+
+def _pair_node(shift, h1, k1, v1, h2, k2, v2):
+    if h1 == h2:
+        return CollisionNode(h1, [k1, v1, k2, v2])
+    node = BitmapNode(0, [])
+    node, _ = node.assoc(shift, h1, k1, v1)
+    node, _ = node.assoc(shift, h2, k2, v2)
+    return node
+
+EMPTY = BitmapNode(0, [])
+
+def find(root, key, notfound=None):
+    h = hash(key) & HASH_MASK
+    node, shift = root, 0
+    while type(node) is BitmapNode:
+        bit = 1 << ((h >> shift) & MASK)
+        bitmap = node.bitmap
+        if not bitmap & bit: return notfound
+        i = 2 * _popcount(bitmap & (bit - 1))
+        k = node.array[i]
+        if k is not _NODE:
+            if k is key or k == key: return node.array[i+1]
+            return notfound
+        node, shift = node.array[i+1], shift + BITS
+    return node.find(shift, h, key, notfound)
+
+def assoc(root, key, val):
+    return root.assoc(0, _hash(key), key, val)
+
+def without(root, key):
+    return root.without(0, _hash(key), key) or EMPTY
+
+def assoc_mut(root, key, val, edit):
+    return root.assoc_mut(edit, 0, _hash(key), key, val)
+
+def without_mut(root, key, edit):
+    return root.without_mut(edit, 0, _hash(key), key) or EMPTY
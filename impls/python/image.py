@@ -0,0 +1,160 @@
+# Images: a pickled repl_env to boot from instead of running the core.mal
+# definitions and load-files again.
+#
+#   (save-image "app.img")          ; in a running stepA
+#   ./run --image app.img [FILE]    ; boots with that repl_env
+#
+# Python builtins (core.ns, eval, save-image) are saved by name and looked
+# up in the booting process. Mal functions and macros are saved as their
+# parts: the tree walker's (ast, env, params), or for MAL_EVAL=analyze
+# and vm the fn* form with its enclosing scope and frame, which is
+# compiled again on load (python 3.7 or later). Everything else (envs,
+# atoms, collections) is pickled as is, lazy seqs as lists of their items,
+# so an image cannot hold python objects that do not pickle.
+
+import os, pickle, sys, types as pytypes
+import mal_types as types
+from env import Env
+
+MAGIC = 'mal-image-2'
+
+# set by stepA_mal: the tree walking EVAL and the builtins saved by name
+EVAL = None
+builtins = {}
+
+def _mode(): return os.environ.get('MAL_EVAL') or 'tree'
+
+# analyzer.py or vm.py, for the fns not made by the tree walker
+def _evaluator():
+    if _mode() == 'vm':
+        import vm
+        return vm
+    import analyzer
+    return analyzer
+
+_FN_CODE = types._function(None, Env, None, None, ()).__code__
+
+# attributes set on fns after _function/_clone creates them
+_STATE = ('__meta__', '_ismacro_', '_impure_', '__malname__')
+
+def _builtin(name): return builtins[name]
+
+def _builtin_clone(name, state):
+    fn = types._clone(builtins[name])
+    fn.__dict__.update(state)
+    return fn
+
+def _tree_fn(ast, env, params):
+    return types._function(EVAL, Env, ast, env, params)
+
+# Compiled fns are saved as the fn they were compiled from, and compiled
+# again once load is done: the globals they refer to are still being
+# unpickled
+_to_compile = []
+
+def _compiled(fn):
+    _to_compile.append(fn)
+    return fn
+
+def _compile_pending(env):
+    import transpiler
+    fns = dict((id(fn), fn) for fn in _to_compile)
+    del _to_compile[:]
+    if env is None: return
+    for k, v in list(env.data.items()):
+        if id(v) in fns: env.data[k] = transpiler.compile_fn(v)
+
+# The env is still being unpickled, so analysis waits until load is done.
+# Until then the fn is a placeholder that is analyzed when first called:
+# analyzing one fn can expand a macro whose fn is still pending.
+_pending = []
+
+class _Args(object):
+    @staticmethod
+    def builder(outer, binds): return lambda args: args
+
+def _analyzed_fn(ast, env, scope, frame):
+    def analyze_and_call(_, args):
+        _analyze(fn, ast, env, scope)
+        return fn(*args)
+    fn = types._function(analyze_and_call, _Args, None, frame, ast[1])
+    _pending.append((fn, ast, env, scope))
+    return fn
+
+def _analyze(fn, ast, env, scope):
+    if fn.__ast__ is not None: return
+    made = _evaluator().analyze_fn(ast, env, scope, False)(fn.__env__)
+    # fill in the evaluator, body and frame builder captured by fn (and
+    # its __gen_env__)
+    for name, cell, made_cell in zip(_FN_CODE.co_freevars, fn.__closure__,
+                                     made.__closure__):
+        if name in ('Eval', 'gen_env', 'ast'):
+            cell.cell_contents = made_cell.cell_contents
+    fn.__ast__ = made.__ast__
+    fn.__gen_env__ = made.__gen_env__
+
+def _analyze_pending():
+    while _pending: _analyze(*_pending.pop())
+
+# Pickling calls reducer_override for functions from python 3.8 on. Before
+# that, the pure python pickler (pickle.Pickler on python 2) is used and
+# its dispatch table sends functions to reducer_override.
+_OVERRIDE = sys.version_info >= (3, 8)
+_BasePickler = pickle.Pickler if _OVERRIDE else getattr(pickle, '_Pickler', pickle.Pickler)
+
+class Pickler(_BasePickler):
+    def __init__(self, f):
+        _BasePickler.__init__(self, f, pickle.HIGHEST_PROTOCOL)
+        self.names = dict((id(v), k) for k, v in builtins.items())
+        self.codes = dict((v.__code__, k) for k, v in builtins.items()
+                          if type(v) == pytypes.FunctionType)
+
+    def reducer_override(self, obj):
+        if type(obj) != pytypes.FunctionType: return NotImplemented
+        if id(obj) in self.names: return _builtin, (self.names[id(obj)],)
+        if '__compiled_from__' in obj.__dict__:
+            return _compiled, (obj.__compiled_from__,)
+        state = dict((k, obj.__dict__[k]) for k in _STATE if k in obj.__dict__)
+        if obj.__code__ in self.codes:
+            return _builtin_clone, (self.codes[obj.__code__], state)
+        if obj.__code__ is not _FN_CODE: return NotImplemented
+        cells = dict(zip(obj.__code__.co_freevars,
+                         (c.cell_contents for c in obj.__closure__)))
+        if cells['Eval'] is EVAL:
+            args = (cells['ast'], obj.__env__, obj.__params__)
+            return _tree_fn, args, state
+        ast, env, scope = _evaluator().sources[cells['ast']]
+        return _analyzed_fn, (ast, env, scope, obj.__env__), state
+
+    if not _OVERRIDE:
+        def save_function(self, obj):
+            rv = self.reducer_override(obj)
+            if rv is NotImplemented: return self.save_global(obj)
+            self.save_reduce(obj=obj, *rv)
+        dispatch = dict(_BasePickler.dispatch)
+        dispatch[pytypes.FunctionType] = save_function
+
+# Analyzed fns are rebuilt by filling in the closure cells of a
+# placeholder, which python allows from 3.7 on
+def _check_mode():
+    if _mode() != 'tree' and sys.version_info < (3, 7):
+        raise Exception("images with MAL_EVAL=%s need python 3.7 or later" % _mode())
+
+def save(path, env):
+    _check_mode()
+    with open(path, 'wb') as f:
+        pickle.dump((MAGIC, _mode()), f)
+        Pickler(f).dump(env)
+
+def load(path):
+    _check_mode()
+    with open(path, 'rb') as f:
+        try: magic, mode = pickle.load(f)
+        except Exception: magic = mode = None
+        if magic != MAGIC: raise Exception("%s: not a mal image" % path)
+        if mode != _mode():
+            raise Exception("%s: saved with MAL_EVAL=%s" % (path, mode))
+        env = pickle.load(f)
+    _analyze_pending()
+    _compile_pending(env)
+    return env
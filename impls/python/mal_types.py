@@ -1,4 +1,6 @@
-import sys, copy, types as pytypes
+import sys, copy, threading, weakref, types as pytypes
+from itertools import chain, islice
+import hamt, pvector, profiler
 
 # python 3.0 differences
 if sys.hexversion > 0x3000000:
@@ -17,6 +19,7 @@ else:
 # General functions
 
 def _equal_Q(a, b):
+    if a is b: return True
     ota, otb = type(a), type(b)
     if _string_Q(a) and _string_Q(b):
         return a == b
@@ -24,35 +27,38 @@ def _equal_Q(a, b):
         return False;
     if _symbol_Q(a):
         return a == b
-    elif _list_Q(a) or _vector_Q(a):
+    elif _sequential_Q(a):
         if len(a) != len(b): return False
-        for i in range(len(a)):
-            if not _equal_Q(a[i], b[i]): return False
+        for x, y in zip(a, b):
+            if not _equal_Q(x, y): return False
         return True
     elif _hash_map_Q(a):
-        akeys = sorted(a.keys())
-        bkeys = sorted(b.keys())
-        if len(akeys) != len(bkeys): return False
-        for i in range(len(akeys)):
-            if akeys[i] != bkeys[i]: return False
-            if not _equal_Q(a[akeys[i]], b[bkeys[i]]): return False
+        if len(a) != len(b): return False
+        for k, v in a.items():
+            if k not in b: return False
+            if not _equal_Q(v, b[k]): return False
         return True
     else:
         return a == b
 
-def _sequential_Q(seq): return _list_Q(seq) or _vector_Q(seq)
+def _sequential_Q(seq): return _list_Q(seq) or _vector_Q(seq) or _lazy_seq_Q(seq)
 
+# A clone of a mal fn keeps the env and params it was made in (see
+# _function), which image.py saves it with
 def _clone(obj):
     #if type(obj) == type(lambda x:x):
     if type(obj) == pytypes.FunctionType:
         if obj.__code__:
-            return pytypes.FunctionType(
+            fn = pytypes.FunctionType(
                     obj.__code__, obj.__globals__, name = obj.__name__,
                     argdefs = obj.__defaults__, closure = obj.__closure__)
         else:
-            return pytypes.FunctionType(
+            fn = pytypes.FunctionType(
                     obj.func_code, obj.func_globals, name = obj.func_name,
                     argdefs = obj.func_defaults, closure = obj.func_closure)
+        for k in ('__env__', '__params__'):
+            if k in obj.__dict__: fn.__dict__[k] = obj.__dict__[k]
+        return fn
     else:
         return copy.copy(obj)
 
@@ -68,78 +74,509 @@ class MalException(Exception):
 def _nil_Q(exp):    return exp is None
 def _true_Q(exp):   return exp is True
 def _false_Q(exp):  return exp is False
-def _string_Q(exp):
-    if type(exp) in str_types:
-        return len(exp) == 0 or exp[0] != _u("\u029e")
-    else:
-        return False
+def _string_Q(exp): return type(exp) in str_types
 def _number_Q(exp): return type(exp) == int
 
 # Symbols
-class Symbol(str): pass
-def _symbol(str): return Symbol(str)
+# Interned: the reader and symbol return one Symbol per name, so comparing
+# symbols and looking them up in Env.data mostly stops at identity. Only
+# with-meta makes another one: an uninterned copy, so that its meta stays
+# off the interned symbol. The table only holds symbols that are in use
+# elsewhere, so symbols made from data (symbol, gensyms) do not stay for
+# the life of the process; except on python 2, which cannot weakly
+# reference a str subclass and keeps every symbol.
+class Symbol(str):
+    def __copy__(self): return Symbol(str(self))
+    def __reduce__(self): return _symbol, (str(self),)
+try:
+    weakref.ref(Symbol())
+    _symbols = weakref.WeakValueDictionary()
+except TypeError:
+    _symbols = {}
+def _symbol(name):
+    sym = _symbols.get(name)
+    if sym is None: sym = _symbols[name] = Symbol(name)
+    return sym
 def _symbol_Q(exp): return type(exp) == Symbol
 
 # Keywords
-# A specially prefixed string
-def _keyword(str):
-    if str[0] == _u("\u029e"): return str
-    else:                      return _u("\u029e") + str
-def _keyword_Q(exp):
-    if type(exp) in str_types:
-        return len(exp) != 0 and exp[0] == _u("\u029e")
-    else:
-        return False
+# Interned like symbols, in a table that only holds keywords in use. The
+# string is the name prefixed with \u029e, so that a keyword never equals a
+# string in a hash-map.
+class Keyword(type(_u("\u029e"))):
+    __slots__ = ('__weakref__',)
+    def __reduce__(self): return _keyword, (self[1:],)
+_keywords = weakref.WeakValueDictionary()
+def _keyword(name):
+    if type(name) == Keyword: return name
+    kw = _keywords.get(name)
+    if kw is None: kw = _keywords[name] = Keyword(_u("\u029e") + name)
+    return kw
+def _keyword_Q(exp): return type(exp) == Keyword
 
 # Functions
+# Env.builder (or analyzer.Frames.builder) makes gen_env, which builds
+# the env of a call from its args. __env__ and __params__ are kept for
+# image.py and transpiler.py.
 def _function(Eval, Env, ast, env, params):
+    gen_env = Env.builder(env, params)
     def fn(*args):
-        return Eval(ast, Env(env, params, List(args)))
+        if profiler.enabled:
+            return profiler.call(fn, Eval, ast, gen_env(args))
+        return Eval(ast, gen_env(args))
     fn.__meta__ = None
     fn.__ast__ = ast
-    fn.__gen_env__ = lambda args: Env(env, params, args)
+    fn.__env__ = env
+    fn.__params__ = params
+    fn.__gen_env__ = gen_env
     return fn
 def _function_Q(f):
     return callable(f)
 
+# Macros
+# Expansions are cached per call site unless the fn given to defmacro!
+# has {:impure true} metadata.
+def _macro(f):
+    mac = _clone(f)
+    mac._ismacro_ = True
+    meta = getattr(f, '__meta__', None)
+    if _hash_map_Q(meta) and meta.get(_keyword('impure')):
+        mac._impure_ = True
+    return mac
+
 # lists
-class List(list):
-    def __add__(self, rhs): return List(list.__add__(self, rhs))
+# Persistent: a list is the first _end entries of a python list _arr that
+# holds the elements last to first, so rest is the same _arr with a
+# smaller _end and cons appends to _arr, sharing it when the list being
+# consed onto ends at the end of _arr (otherwise cons copies it). first,
+# rest, cons, count and indexing are O(1).
+class List(object):
+    __hash__ = None
+
+    def __init__(self, items=()):
+        arr = list(items)
+        arr.reverse()
+        self._arr, self._end = arr, len(arr)
+
+    @staticmethod
+    def _view(arr, end):
+        lst = List.__new__(List)
+        lst._arr, lst._end = arr, end
+        return lst
+
+    def cons(self, x):
+        arr, end = self._arr, self._end
+        if len(arr) == end:
+            arr.append(x)
+            # another cons onto the same list may have appended first
+            if arr[end] is x: return List._view(arr, end + 1)
+        arr = arr[:end]
+        arr.append(x)
+        return List._view(arr, end + 1)
+
+    def __len__(self): return self._end
     def __getitem__(self, i):
-        if type(i) == slice: return List(list.__getitem__(self, i))
-        elif i >= len(self): return None
-        else:                return list.__getitem__(self, i)
-    def __getslice__(self, *a): return List(list.__getslice__(self, *a))
+        end = self._end
+        if type(i) == slice:
+            start, stop, step = i.indices(end)
+            if step != 1: return List(list(self)[i])
+            if stop <= start: return List()
+            if stop == end: return List._view(self._arr, end - start)
+            return List._view(self._arr[end-stop:end-start], stop - start)
+        if i < 0: i += end
+        if not 0 <= i < end: return None
+        return self._arr[end - 1 - i]
+    def __iter__(self): return reversed(self._arr[:self._end])
+    def __reversed__(self): return iter(self._arr[:self._end])
+    def __add__(self, rhs): return List(chain(self, rhs))
+    def __eq__(self, other):
+        return (type(other) == List and len(self) == len(other) and
+                all(a == b for a, b in zip(self, other)))
+    def __ne__(self, other): return not self == other
+    def __repr__(self): return 'List(%r)' % list(self)
 def _list(*vals): return List(vals)
 def _list_Q(exp):   return type(exp) == List
 
+# lazy sequences
+# A LazySeq calls fn once, when first needed, for a seq (or nil) to stand
+# for. Realized, it is a view of a chunk (a python list) from offset _off,
+# followed by the LazySeq _more (None at the end). Python iterators are
+# realized CHUNK elements at a time, so only a chunk of a pipeline such as
+# (take 10 (lazy-map f (range))) is in memory at once.
+CHUNK = 32
+
+class LazySeq(object):
+    __hash__ = None
+
+    def __init__(self, fn):
+        self._fn = fn
+
+    @staticmethod
+    def _view(chunk, off, more):
+        s = LazySeq(None)
+        s._chunk, s._off, s._more = chunk, off, more
+        return s
+
+    def _realize(self):
+        fn = self._fn
+        if fn is None: return self
+        self._fn = None
+        s = fn()
+        if type(s) == LazySeq:
+            s._realize()
+            self._chunk, self._off, self._more = s._chunk, s._off, s._more
+        else:
+            self._chunk, self._off, self._more = list(s or ()), 0, None
+        return self
+
+    def first(self):
+        self._realize()
+        if self._off < len(self._chunk): return self._chunk[self._off]
+        return None
+
+    def rest(self):
+        self._realize()
+        if self._off + 1 < len(self._chunk):
+            return LazySeq._view(self._chunk, self._off + 1, self._more)
+        return self._more if self._more is not None else List()
+
+    def cons(self, x): return LazySeq._view([x], 0, self)
+
+    # a copy (with-meta) realizes through the original, so the two share
+    # one realization instead of both pulling from its iterator
+    def __copy__(self): return LazySeq(self._realize)
+    # pickled (for images and parallel.py) as the list of its items: the
+    # thunks over python iterators do not pickle
+    def __reduce__(self): return List, (list(self),)
+
+    def empty(self):
+        self._realize()
+        return self._off >= len(self._chunk)
+
+    def __iter__(self):
+        s = self
+        del self # don't hold on to the head while walking
+        while s is not None:
+            s._realize()
+            for x in s._chunk[s._off:]: yield x
+            s = s._more
+    def __len__(self):
+        n, s = 0, self
+        while s is not None:
+            s._realize()
+            n += len(s._chunk) - s._off
+            s = s._more
+        return n
+    def __bool__(self): return not self.empty()
+    __nonzero__ = __bool__
+    def __getitem__(self, i):
+        if type(i) == slice: return List(list(self)[i])
+        if i < 0: return list(self)[i]
+        s = self
+        while s is not None:
+            s._realize()
+            n = len(s._chunk) - s._off
+            if i < n: return s._chunk[s._off + i]
+            i -= n
+            s = s._more
+        return None
+    def __eq__(self, other):
+        return (type(other) == LazySeq and len(self) == len(other) and
+                all(a == b for a, b in zip(self, other)))
+    def __ne__(self, other): return not self == other
+    def __repr__(self): return 'LazySeq(%r)' % list(self)
+
+# A LazySeq of the rest of the python iterator it
+def _lazy_iter(it):
+    def fn():
+        chunk = list(islice(it, CHUNK))
+        more = _lazy_iter(it) if len(chunk) == CHUNK else None
+        return LazySeq._view(chunk, 0, more)
+    return LazySeq(fn)
+def _lazy_seq_Q(exp): return type(exp) == LazySeq
+
 
 # vectors
-class Vector(list):
-    def __add__(self, rhs): return Vector(list.__add__(self, rhs))
+# Persistent: conj/assoc return a new vector sharing structure with this
+# one (see pvector.py). Reading works like a read-only list.
+class Vector(object):
+    __hash__ = None
+
+    def __init__(self, items=()):
+        items = list(items)
+        self._cnt = len(items)
+        self._root, self._shift, self._tail = pvector.build(items)
+
+    def _derive(self, cnt, shift, root, tail):
+        vec = Vector.__new__(Vector)
+        vec.__dict__.update(self.__dict__)
+        vec._cnt, vec._shift, vec._root, vec._tail = cnt, shift, root, tail
+        return vec
+
+    def conj(self, *vals):
+        cnt, shift, root, tail = self._cnt, self._shift, self._root, self._tail
+        for val in vals:
+            if cnt - pvector.tailoff(cnt) < pvector.WIDTH:
+                tail = tail + [val]
+            else:
+                if (cnt >> pvector.BITS) > (1 << shift):
+                    root = [root, pvector.new_path(shift, tail)]
+                    shift += pvector.BITS
+                else:
+                    root = pvector.push_tail(cnt, shift, root, tail)
+                tail = [val]
+            cnt += 1
+        return self._derive(cnt, shift, root, tail)
+
+    def assoc(self, i, val):
+        if i == self._cnt: return self.conj(val)
+        if not 0 <= i < self._cnt: raise IndexError("assoc: index out of range")
+        off = pvector.tailoff(self._cnt)
+        if i >= off:
+            tail = self._tail[:]
+            tail[i - off] = val
+            return self._derive(self._cnt, self._shift, self._root, tail)
+        root = pvector.assoc(self._shift, self._root, i, val)
+        return self._derive(self._cnt, self._shift, root, self._tail)
+
+    def __len__(self): return self._cnt
     def __getitem__(self, i):
-        if type(i) == slice: return Vector(list.__getitem__(self, i))
-        elif i >= len(self): return None
-        else:                return list.__getitem__(self, i)
-    def __getslice__(self, *a): return Vector(list.__getslice__(self, *a))
+        if type(i) == slice: return Vector(list(self)[i])
+        if i < 0: i += self._cnt
+        if not 0 <= i < self._cnt: return None
+        off = pvector.tailoff(self._cnt)
+        if i >= off: return self._tail[i - off]
+        return pvector.leaf_for(self._root, self._shift, i)[i & pvector.MASK]
+    def __iter__(self):
+        for leaf in pvector.leaves(self._shift, self._root):
+            for x in leaf: yield x
+        for x in self._tail: yield x
+    def __reversed__(self): return reversed(list(self))
+    def __add__(self, rhs): return self.conj(*rhs)
+    def __eq__(self, other):
+        return (type(other) == Vector and len(self) == len(other) and
+                all(a == b for a, b in zip(self, other)))
+    def __ne__(self, other): return not self == other
+    def __repr__(self): return 'Vector(%r)' % list(self)
 def _vector(*vals): return Vector(vals)
 def _vector_Q(exp): return type(exp) == Vector
 
 # Hash maps
-class Hash_Map(dict): pass
+# Persistent: assoc/dissoc return a new map sharing structure with this
+# one (see hamt.py). Reading works like a read-only dict, in insertion
+# order like the dict did: the trie would iterate in the order of the
+# string hashes, which differ per process. So it maps each key to
+# (insertion number, value), an assoc of a key already in the map keeps
+# its number, and iteration sorts by it.
+class Hash_Map(object):
+    __hash__ = None
+
+    def __init__(self, items=()):
+        if hasattr(items, 'items'): items = items.items()
+        root, count, n = hamt.EMPTY, 0, 0
+        for k, v in items:
+            root, added, n = _ordered_assoc(root, k, v, n)
+            if added: count += 1
+        self._root, self._count, self._next = root, count, n
+
+    # the trie depends on this process's string hashes, so pickle the items
+    def __reduce__(self):
+        state = dict(self.__dict__)
+        del state['_root'], state['_count'], state['_next']
+        return Hash_Map, (list(self.items()),), state or None
+
+    def _derive(self, root, count, n):
+        hm = Hash_Map.__new__(Hash_Map)
+        hm.__dict__.update(self.__dict__)
+        hm._root, hm._count, hm._next = root, count, n
+        return hm
+
+    def assoc(self, *key_vals):
+        root, count, n = self._root, self._count, self._next
+        for i in range(0, len(key_vals), 2):
+            root, added, n = _ordered_assoc(root, key_vals[i], key_vals[i+1], n)
+            if added: count += 1
+        return self._derive(root, count, n)
+
+    def dissoc(self, *keys):
+        root, count = self._root, self._count
+        for k in keys:
+            new_root = hamt.without(root, k)
+            if new_root is not root: root, count = new_root, count - 1
+        return self._derive(root, count, self._next)
+
+    def get(self, key, default=None):
+        entry = hamt.find(self._root, key, _missing)
+        return default if entry is _missing else entry[1]
+    def __getitem__(self, key):
+        entry = hamt.find(self._root, key, _missing)
+        if entry is _missing: raise KeyError(key)
+        return entry[1]
+    def __contains__(self, key):
+        return hamt.find(self._root, key, _missing) is not _missing
+    def __len__(self): return self._count
+    def __iter__(self): return (k for k, v in self.items())
+    def keys(self): return iter(self)
+    def values(self): return (v for k, v in self.items())
+    def items(self):
+        entries = sorted(self._root.items(), key=_insertion_number)
+        return ((k, entry[1]) for k, entry in entries)
+    def __eq__(self, other):
+        return (type(other) == Hash_Map and len(self) == len(other) and
+                all(k in other and other[k] == v for k, v in self.items()))
+    def __ne__(self, other): return not self == other
+_missing = object()
+def _insertion_number(item): return item[1][0]
+# assoc of key to (insertion number, val) in the trie root, in place
+# with an edit token; returns the root, whether the key is new, and the
+# next insertion number
+def _ordered_assoc(root, key, val, n, edit=None):
+    entry = hamt.find(root, key, _missing)
+    if entry is _missing: entry, n = (n, val), n + 1
+    else:                 entry = (entry[0], val)
+    if edit is None: root, added = hamt.assoc(root, key, entry)
+    else:            root, added = hamt.assoc_mut(root, key, entry, edit)
+    return root, added, n
 def _hash_map(*key_vals):
-    hm = Hash_Map()
-    for i in range(0,len(key_vals),2): hm[key_vals[i]] = key_vals[i+1]
-    return hm
+    return Hash_Map().assoc(*key_vals)
 def _hash_map_Q(exp): return type(exp) == Hash_Map
 
+# Transients
+# A vector or hash-map being built up in place by conj!/assoc!/dissoc!:
+# it changes the trie nodes it has copied (see pvector.py and hamt.py)
+# rather than copying a path for every update. persistent! returns the
+# result in O(1) and retires the transient, which only the thread that
+# made it may use.
+class Transient(object):
+    def _check(self):
+        if self._edit is None:
+            raise MalException("transient used after persistent! call")
+        if self._owner is not threading.current_thread():
+            raise MalException("transient used by non-owner thread")
+
+    def __len__(self):
+        self._check()
+        return self._cnt
+
+class TransientVector(Transient):
+    def __init__(self, vec):
+        self._owner = threading.current_thread()
+        # ids of the nodes this transient owns
+        self._edit = set()
+        self._cnt, self._shift, self._root = vec._cnt, vec._shift, vec._root
+        self._tail = vec._tail[:]
+
+    def conj(self, *vals):
+        self._check()
+        cnt, shift, root, tail = self._cnt, self._shift, self._root, self._tail
+        for val in vals:
+            if len(tail) < pvector.WIDTH:
+                tail.append(val)
+            else:
+                if (cnt >> pvector.BITS) > (1 << shift):
+                    root = [root, pvector.new_path(shift, tail)]
+                    self._edit.add(id(root))
+                    shift += pvector.BITS
+                else:
+                    root = pvector.push_tail_mut(cnt, shift, root, tail, self._edit)
+                tail = [val]
+            cnt += 1
+        self._cnt, self._shift, self._root, self._tail = cnt, shift, root, tail
+        return self
+
+    def assoc(self, i, val):
+        self._check()
+        if i == self._cnt: return self.conj(val)
+        if not 0 <= i < self._cnt: raise IndexError("assoc!: index out of range")
+        off = pvector.tailoff(self._cnt)
+        if i >= off:
+            self._tail[i - off] = val
+        else:
+            self._root = pvector.assoc_mut(self._shift, self._root, i, val, self._edit)
+        return self
+
+    def __getitem__(self, i):
+        self._check()
+        if not 0 <= i < self._cnt: return None
+        off = pvector.tailoff(self._cnt)
+        if i >= off: return self._tail[i - off]
+        return pvector.leaf_for(self._root, self._shift, i)[i & pvector.MASK]
+
+    def persistent(self):
+        self._check()
+        self._edit = None
+        vec = Vector.__new__(Vector)
+        vec._cnt, vec._shift, vec._root, vec._tail = (
+            self._cnt, self._shift, self._root, self._tail)
+        return vec
+
+class TransientHashMap(Transient):
+    def __init__(self, hm):
+        self._owner = threading.current_thread()
+        # tags the trie nodes this transient owns
+        self._edit = object()
+        self._root, self._cnt, self._next = hm._root, hm._count, hm._next
+
+    def assoc(self, *key_vals):
+        self._check()
+        root, cnt, n, edit = self._root, self._cnt, self._next, self._edit
+        for i in range(0, len(key_vals), 2):
+            root, added, n = _ordered_assoc(root, key_vals[i], key_vals[i+1], n, edit)
+            if added: cnt += 1
+        self._root, self._cnt, self._next = root, cnt, n
+        return self
+
+    def dissoc(self, *keys):
+        self._check()
+        for k in keys:
+            if hamt.find(self._root, k, _missing) is not _missing:
+                self._root = hamt.without_mut(self._root, k, self._edit)
+                self._cnt -= 1
+        return self
+
+    def get(self, key, default=None):
+        self._check()
+        entry = hamt.find(self._root, key, _missing)
+        return default if entry is _missing else entry[1]
+    def __contains__(self, key):
+        self._check()
+        return hamt.find(self._root, key, _missing) is not _missing
+
+    def persistent(self):
+        self._check()
+        self._edit = None
+        hm = Hash_Map.__new__(Hash_Map)
+        hm._root, hm._count, hm._next = self._root, self._cnt, self._next
+        return hm
+
+def _transient_Q(exp): return isinstance(exp, Transient)
+
 # atoms
+# Changed under one lock shared by all atoms, as a lock per atom would not
+# pickle into images or to worker processes
+_atom_lock = threading.Lock()
 class Atom(object):
     def __init__(self, val):
         self.val = val
+    def compare_and_set(self, old, new):
+        with _atom_lock:
+            if self.val is not old: return False
+            self.val = new
+            return True
+    def reset(self, new):
+        with _atom_lock: self.val = new
+        return new
 def _atom(val): return Atom(val)
 def _atom_Q(exp):   return type(exp) == Atom
 
+# reduced: returned by a reducing fn to end reduce with val
+class Reduced(object):
+    def __init__(self, val):
+        self.val = val
+    def deref(self): return self.val
+def _reduced(val): return Reduced(val)
+def _reduced_Q(exp): return type(exp) == Reduced
+
 def py_to_mal(obj):
         if type(obj) == list:   return List(obj)
         if type(obj) == tuple:  return List(obj)
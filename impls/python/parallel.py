@@ -0,0 +1,182 @@
+# Parallel evaluation on a pool of worker processes.
+#
+#   (pmap f coll & colls)   ; like map, with the calls spread over workers
+#   (pcalls f g ...)        ; the results of calling each fn, in parallel
+#   (pfuture body...)       ; runs body in a worker; deref waits for it
+#
+# Workers are forked from this process, so they start with a copy of a
+# warm repl_env. Calls and their results are sent as pickles: mal data as
+# is, mal functions as their parts (see image.py), and the globals of
+# repl_env by name. As a worker only has the globals of when it was
+# forked, the pool is forked again once repl_env has changed. Side
+# effects in a worker, like swap! on an atom, stay in that worker.
+#
+# MAL_WORKERS (default: the number of cpus) and MAL_CHUNK_SIZE (default:
+# about four chunks per worker) set the size of the pool and how many of
+# pmap's calls go to a worker at once; (parallel-options {:workers n
+# :chunk-size n}) sets them from mal. Without fork or python 3.7 (or when
+# already in a worker) everything runs in the calling process. Lazy seqs
+# are sent as lists of their items.
+
+import io, os, pickle, sys
+try:
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor, TimeoutError
+except ImportError:
+    ProcessPoolExecutor = None
+import mal_types as types
+from mal_types import List
+import image
+
+# set by stepA_mal
+repl_env = None
+
+def _cpus():
+    try:    return multiprocessing.cpu_count()
+    except Exception: return 1
+
+options = {
+    'workers': int(os.environ.get('MAL_WORKERS') or 0) or _cpus(),
+    'chunk-size': int(os.environ.get('MAL_CHUNK_SIZE') or 0) or None,
+}
+
+_pool = None
+# repl_env as the workers of _pool have it: (size, version) and the
+# names of its values by id
+_stamp = None
+_globals = {}
+_in_worker = False
+
+# ProcessPoolExecutor takes mp_context and initializer from python 3.7 on
+def _forking():
+    return (ProcessPoolExecutor is not None and not _in_worker and
+            sys.version_info >= (3, 7) and
+            'fork' in multiprocessing.get_all_start_methods())
+
+def _worker_init():
+    global _in_worker
+    _in_worker = True
+
+def _get_pool():
+    global _pool, _stamp, _globals
+    stamp = (len(repl_env.data), repl_env.version)
+    if _pool is not None and _stamp == stamp: return _pool
+    shutdown()
+    _stamp = stamp
+    _globals = dict((id(v), str(k)) for k, v in repl_env.data.items())
+    _pool = ProcessPoolExecutor(options['workers'],
+                                mp_context=multiprocessing.get_context('fork'),
+                                initializer=_worker_init)
+    return _pool
+
+def shutdown():
+    global _pool
+    if _pool is not None: _pool.shutdown()
+    _pool = None
+
+# Pickling
+
+class Pickler(image.Pickler):
+    def persistent_id(self, obj):
+        if obj is repl_env: return ('env',)
+        name = _globals.get(id(obj))
+        if name is not None and repl_env.data.get(name) is obj:
+            return ('global', name)
+        return None
+
+class Unpickler(pickle.Unpickler):
+    def persistent_load(self, pid):
+        if pid[0] == 'env': return repl_env
+        return repl_env.data[pid[1]]
+
+def _dumps(obj):
+    f = io.BytesIO()
+    Pickler(f).dump(obj)
+    return f.getvalue()
+
+def _loads(data):
+    obj = Unpickler(io.BytesIO(data)).load()
+    image._analyze_pending()
+    image._compile_pending(None)
+    return obj
+
+# Worker side. A chunk is (pickled fn, pickled argument lists); the last
+# fn is kept so that the chunks of one pmap only unpickle it once.
+_last_fn = (None, None)
+
+def _call_chunk(fn_data, args_data):
+    global _last_fn
+    try:
+        if _last_fn[0] != fn_data: _last_fn = (fn_data, _loads(fn_data))
+        f = _last_fn[1]
+        return False, _dumps([f(*args) for args in _loads(args_data)])
+    except Exception as e:
+        return True, _dump_error(e)
+
+def _dump_error(e):
+    try:
+        return _dumps(e)
+    except Exception:
+        if isinstance(e, types.MalException):
+            import printer
+            return _dumps(types.MalException(printer._pr_str(e.object)))
+        return _dumps(Exception("%s: %s" % (type(e).__name__, e)))
+
+def _results(ret):
+    failed, data = ret
+    if failed: raise _loads(data)
+    return _loads(data)
+
+def _submit(pool, fn_data, arg_lists):
+    return pool.submit(_call_chunk, fn_data, _dumps(arg_lists))
+
+# Mal functions
+
+def pmap(f, *colls):
+    arg_lists = list(zip(*[() if c is None else list(c) for c in colls]))
+    if not _forking() or not arg_lists:
+        return List([f(*args) for args in arg_lists])
+    pool = _get_pool()
+    size = options['chunk-size'] or -(-len(arg_lists) // (4 * options['workers']))
+    fn_data = _dumps(f)
+    futures = [_submit(pool, fn_data, arg_lists[i:i+size])
+               for i in range(0, len(arg_lists), size)]
+    return List([x for fut in futures for x in _results(fut.result())])
+
+def pcalls(*fns):
+    if not _forking(): return List([f() for f in fns])
+    pool = _get_pool()
+    futures = [_submit(pool, _dumps(f), [()]) for f in fns]
+    return List([_results(fut.result())[0] for fut in futures])
+
+class Future(object):
+    def __init__(self, f):
+        if _forking():
+            self._future = _submit(_get_pool(), _dumps(f), [()])
+        else:
+            self._future, self._value = None, f()
+    def realized(self):
+        return self._future is None or self._future.done()
+    def deref(self, timeout_ms=None, timeout_val=None):
+        if self._future is not None:
+            try:
+                ret = self._future.result(None if timeout_ms is None
+                                          else timeout_ms / 1000.0)
+            except TimeoutError:
+                return timeout_val
+            self._value = _results(ret)[0]
+            self._future = None
+        return self._value
+
+def future_call(f): return Future(f)
+
+def parallel_options(new=None):
+    if new is not None:
+        for k, v in new.items():
+            name = k[1:] if types._keyword_Q(k) else k
+            if name not in options: raise types.MalException(
+                "parallel-options: unknown option %s" % name)
+            options[name] = v
+        if types._keyword('workers') in new: shutdown()
+    return types._hash_map(*[x for k, v in sorted(options.items())
+                             for x in (types._keyword(k), v)])
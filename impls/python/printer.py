@@ -5,19 +5,19 @@ def _escape(s):
 
 def _pr_str(obj, print_readably=True):
     _r = print_readably
-    if types._list_Q(obj):
+    if types._list_Q(obj) or types._lazy_seq_Q(obj):
         return "(" + " ".join(map(lambda e: _pr_str(e,_r), obj)) + ")"
     elif types._vector_Q(obj):                                    
         return "[" + " ".join(map(lambda e: _pr_str(e,_r), obj)) + "]"
     elif types._hash_map_Q(obj):
         ret = []
-        for k in obj.keys():
-            ret.extend((_pr_str(k), _pr_str(obj[k],_r)))
+        for k, v in obj.items():
+            ret.extend((_pr_str(k), _pr_str(v,_r)))
         return "{" + " ".join(ret) + "}"
+    elif types._keyword_Q(obj):
+        return ':' + obj[1:]
     elif type(obj) in types.str_types:
-        if len(obj) > 0 and obj[0] == types._u('\u029e'):
-            return ':' + obj[1:]
-        elif print_readably:
+        if print_readably:
             return '"' + _escape(obj) + '"'
         else:
             return obj
@@ -0,0 +1,136 @@
+# Per-function profiler for mal code.
+#
+#   MAL_PROFILE=report ./run prog.mal            # report on stderr at exit
+#   MAL_PROFILE=collapsed:prog.folded ./run ...  # stacks for flamegraph.pl
+#   (profile (main))                             ; report on stderr
+#
+# Functions are profiled under the name they were given by def! (see
+# name()); calls to anonymous fns count toward the nearest named caller.
+# A function's activation starts when its body is entered and ends when
+# the evaluator frame running it returns or moves on to the body of a tail
+# call, so each python frame of EVAL (or run in analyzer.py) holds at
+# most one activation and tail-recursive loops do not grow the stack.
+# Macros are recorded separately with their expansion count and time.
+#
+# When profiling is off the evaluators only test `enabled`.
+
+import atexit, os, sys, time
+
+clock = getattr(time, 'perf_counter', time.time)
+
+enabled = False
+
+# one [name, is_macro, start, child_time, owner] per activation
+stack = []
+names = []
+active = {}
+# name -> [calls, inclusive, exclusive, expansions, expansion time]
+stats = {}
+# 'outer;inner' -> exclusive time
+stacks = {}
+
+def start():
+    global enabled
+    del stack[:], names[:]
+    active.clear(), stats.clear(), stacks.clear()
+    enabled = True
+
+def stop():
+    global enabled
+    enabled = False
+
+# Called by def!/defmacro!: functions keep the first name they get
+def name(value, sym):
+    if ((hasattr(value, '__ast__') or hasattr(value, '_ismacro_')) and
+            not hasattr(value, '__malname__')):
+        value.__malname__ = str(sym)
+    return value
+
+def push(f, is_macro=False, owner=None):
+    name = getattr(f, '__malname__', None)
+    if name is None: return False
+    stack.append([name, is_macro, clock(), 0.0, owner])
+    names.append(name)
+    active[name] = active.get(name, 0) + 1
+    return True
+
+def pop():
+    if not stack: return  # start() was called during the activation
+    name, is_macro, start, child, owner = stack.pop()
+    elapsed = clock() - start
+    if stack: stack[-1][3] += elapsed
+    st = stats.get(name)
+    if st is None: st = stats[name] = [0, 0.0, 0.0, 0, 0.0]
+    if is_macro:
+        st[3] += 1
+        st[4] += elapsed
+    else:
+        st[0] += 1
+        if active[name] == 1: st[1] += elapsed  # outermost of a recursion
+        st[2] += elapsed - child
+    active[name] -= 1
+    path = ';'.join(names)
+    stacks[path] = stacks.get(path, 0.0) + elapsed - child
+    names.pop()
+
+# A python level call of a mal fn (from a builtin like map, or a
+# non-tail call in analyzer.py). The activation is owned by env, so that
+# the trampoline in run can hand it over to tail calls.
+def call(f, Eval, ast, env):
+    if not push(f, False, env): return Eval(ast, env)
+    try:
+        return Eval(ast, env)
+    finally:
+        if stack and stack[-1][4] is env: pop()
+
+def expand(mac, args):
+    if not push(mac, True): return mac(*args)
+    try:
+        return mac(*args)
+    finally:
+        pop()
+
+# analyzer.run with a TailCall result: the trampoline, with an activation
+# for each tail-called fn. A fn body entered through call() replaces the
+# activation of that call, which call() then ends.
+def run(ret, TailCall, env):
+    owner = env if stack and stack[-1][4] is env else None
+    pushed = owner is not None
+    try:
+        while type(ret) is TailCall:
+            if enabled:
+                if pushed: pop()
+                pushed = push(ret.fn, False, owner)
+            ret = ret.node(ret.env)
+        return ret
+    finally:
+        if pushed and owner is None: pop()
+
+def report():
+    rows = sorted(stats.items(), key=lambda kv: -(kv[1][2] + kv[1][4]))
+    lines = ['%10s %12s %12s %10s %12s  %s' % (
+        'calls', 'incl ms', 'excl ms', 'expands', 'expand ms', 'name')]
+    for name, (calls, incl, excl, expands, expand_time) in rows:
+        lines.append('%10d %12.3f %12.3f %10d %12.3f  %s' % (
+            calls, incl * 1000, excl * 1000, expands, expand_time * 1000, name))
+    return '\n'.join(lines)
+
+# Collapsed stacks, one 'outer;inner microseconds' line each
+def collapsed():
+    return ''.join('%s %d\n' % (path, int(t * 1e6))
+                   for path, t in sorted(stacks.items()) if int(t * 1e6))
+
+def print_report():
+    sys.stderr.write(report() + '\n')
+
+def write_collapsed(path):
+    with open(path, 'w') as f: f.write(collapsed())
+
+def _dump_at_exit(mode):
+    stop()
+    if mode.startswith('collapsed:'): write_collapsed(mode[len('collapsed:'):])
+    else:                             print_report()
+
+if os.environ.get('MAL_PROFILE'):
+    start()
+    atexit.register(_dump_at_exit, os.environ['MAL_PROFILE'])
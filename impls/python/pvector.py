@@ -0,0 +1,99 @@
+# Persistent vector trie: the storage behind Vector.
+#
+# Elements live in 32 slot leaves under a tree of 32 way nodes (python
+# lists), plus a tail buffer holding the last 1-32 elements so that conj
+# only touches the tree once every 32 appends. Nodes are never modified
+# once shared, so conj/assoc copy only one path: O(log32 n). The *_mut
+# functions are for transients, which own the nodes they have copied.
+
+BITS = 5
+WIDTH = 1 << BITS
+MASK = WIDTH - 1
+
+def tailoff(cnt):
+    return 0 if cnt < WIDTH else ((cnt - 1) >> BITS) << BITS
+
+# The leaf holding index i, for i < tailoff
+def leaf_for(root, shift, i):
+    node = root
+    while shift > 0:
+        node = node[(i >> shift) & MASK]
+        shift -= BITS
+    return node
+
+def new_path(shift, node):
+    while shift > 0:
+        node = [node]
+        shift -= BITS
+    return node
+
+# Copy of parent with the full tail added as the leaf after the last one
+# (cnt counts the elements of the vector including the tail)
+def push_tail(cnt, shift, parent, tail):
+    subidx = ((cnt - 1) >> shift) & MASK
+    node = parent[:]
+    if shift == BITS:
+        child = tail
+    elif subidx < len(parent):
+        child = push_tail(cnt, shift - BITS, parent[subidx], tail)
+    else:
+        child = new_path(shift - BITS, tail)
+    if subidx < len(node): node[subidx] = child
+    else:                  node.append(child)
+    return node
+
+def assoc(shift, node, i, val):
+    node = node[:]
+    if shift == 0:
+        node[i & MASK] = val
+    else:
+        subidx = (i >> shift) & MASK
+        node[subidx] = assoc(shift - BITS, node[subidx], i, val)
+    return node
+
+# Transient vectors change nodes in place once they own them: owned is
+# the set of ids of the nodes a transient copied
+def _owned(node, owned):
+    if id(node) in owned: return node
+    node = node[:]
+    owned.add(id(node))
+    return node
+
+def push_tail_mut(cnt, shift, parent, tail, owned):
+    subidx = ((cnt - 1) >> shift) & MASK
+    node = _owned(parent, owned)
+    if shift == BITS:
+        child = tail
+    elif subidx < len(node):
+        child = push_tail_mut(cnt, shift - BITS, node[subidx], tail, owned)
+    else:
+        child = new_path(shift - BITS, tail)
+    if subidx < len(node): node[subidx] = child
+    else:                  node.append(child)
+    return node
+
+def assoc_mut(shift, node, i, val, owned):
+    node = _owned(node, owned)
+    if shift == 0:
+        node[i & MASK] = val
+    else:
+        subidx = (i >> shift) & MASK
+        node[subidx] = assoc_mut(shift - BITS, node[subidx], i, val, owned)
+    return node
+
+# (root, shift, tail) holding items, a list
+def build(items):
+    off = tailoff(len(items))
+    nodes = [items[i:i+WIDTH] for i in range(0, off, WIDTH)]
+    shift = BITS
+    while len(nodes) > WIDTH:
+        nodes = [nodes[i:i+WIDTH] for i in range(0, len(nodes), WIDTH)]
+        shift += BITS
+    return nodes, shift, items[off:]
+
+def leaves(shift, node):
+    if shift == 0:
+        yield node
+    else:
+        for child in node:
+            for leaf in leaves(shift - BITS, child): yield leaf
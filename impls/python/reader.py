@@ -1,113 +1,89 @@
 import re
-from mal_types import (_symbol, _keyword, _list, _vector, _hash_map, _s2u, _u)
+from mal_types import (_symbol, _keyword, _list, _hash_map, _s2u, _u,
+                       List, Vector)
 
 class Blank(Exception): pass
 
-class Reader():
-    def __init__(self, tokens, position=0):
-        self.tokens = tokens
-        self.position = position
+# A single pass over the string: read_form dispatches on the first
+# character of the next form and returns it with the position after it.
+# Runs of whitespace/commas/comments, atoms and strings are matched with
+# the regexes below, which match exactly what the token regex used to.
+_skip_re = re.compile(r"(?:[\s,]+|;.*)*")
+# skips to the next form; group 1 is that form if it is an atom
+_atom_re = re.compile(r"""(?:[\s,]+|;.*)*([^\s\[\]{}()'"`@,;~^][^\s\[\]{}()'"`@,;]*)?""")
+# group 1 is None when the closing quote is missing
+_string_re = re.compile(r'"(?:[\\].|[^\\"])*(")?')
+_number_re = re.compile(r"-?[0-9][0-9.]*$")
 
-    def next(self):
-        self.position += 1
-        return self.tokens[self.position-1]
-
-    def peek(self):
-        if len(self.tokens) > self.position:
-            return self.tokens[self.position]
-        else:
-            return None
-
-def tokenize(str):
-    tre = re.compile(r"""[\s,]*(~@|[\[\]{}()'`~^@]|"(?:[\\].|[^\\"])*"?|;.*|[^\s\[\]{}()'"`@,;]+)""");
-    return [t for t in re.findall(tre, str) if t[0] != ';']
+_quotes = {"'": 'quote', '`': 'quasiquote', '~': 'unquote', '@': 'deref'}
+_closers = {')': "unexpected ')'", ']': "unexpected ']'", '}': "unexpected '}'"}
 
 def _unescape(s):
     return s.replace('\\\\', _u('\u029e')).replace('\\"', '"').replace('\\n', '\n').replace(_u('\u029e'), '\\')
 
-def read_atom(reader):
-    int_re = re.compile(r"-?[0-9]+$")
-    float_re = re.compile(r"-?[0-9][0-9.]*$")
-    string_re = re.compile(r'"(?:[\\].|[^\\"])*"')
-    token = reader.next()
-    if re.match(int_re, token):     return int(token)
-    elif re.match(float_re, token): return int(token)
-    elif re.match(string_re, token):return _s2u(_unescape(token[1:-1]))
-    elif token[0] == '"':           raise Exception("expected '\"', got EOF")
+_constants = {"nil": None, "true": True, "false": False}
+
+def read_atom(token):
+    if token[0] in '-0123456789' and _number_re.match(token):
+        return int(token)
     elif token[0] == ':':           return _keyword(token[1:])
-    elif token == "nil":            return None
-    elif token == "true":           return True
-    elif token == "false":          return False
+    elif token in _constants:       return _constants[token]
     else:                           return _symbol(token)
 
-def read_sequence(reader, typ=list, start='(', end=')'):
-    ast = typ()
-    token = reader.next()
-    if token != start: raise Exception("expected '" + start + "'")
-
-    token = reader.peek()
-    while token != end:
-        if not token: raise Exception("expected '" + end + "', got EOF")
-        ast.append(read_form(reader))
-        token = reader.peek()
-    reader.next()
-    return ast
-
-def read_hash_map(reader):
-    lst = read_sequence(reader, list, '{', '}')
-    return _hash_map(*lst)
-
-def read_list(reader):
-    return read_sequence(reader, _list, '(', ')')
+def read_string(s, pos):
+    m = _string_re.match(s, pos)
+    if m.group(1) is None: raise Exception("expected '\"', got EOF")
+    end = m.end()
+    return _s2u(_unescape(s[pos+1:end-1])), end
+
+def read_sequence(s, pos, typ, end):
+    ast = []
+    pos += 1
+    while True:
+        m = _atom_re.match(s, pos)
+        pos = m.end()
+        if m.lastindex:
+            ast.append(read_atom(m.group(1)))
+            continue
+        if pos == len(s): raise Exception("expected '" + end + "', got EOF")
+        if s[pos] == end: return typ(ast), pos + 1
+        form, pos = read_form(s, pos)
+        ast.append(form)
+
+def read_hash_map(s, pos):
+    lst, pos = read_sequence(s, pos, list, '}')
+    return _hash_map(*lst), pos
+
+def read_form(s, pos):
+    m = _atom_re.match(s, pos)
+    pos = m.end()
+    if m.lastindex: return read_atom(m.group(1)), pos
+    if pos == len(s):
+        # only reached after a reader macro: read_str skips blank input
+        raise Exception("expected form after reader macro, got EOF")
+    c = s[pos]
+    if c == '(': return read_sequence(s, pos, List, ')')
+    elif c == '[': return read_sequence(s, pos, Vector, ']')
+    elif c == '{': return read_hash_map(s, pos)
+    elif c == '"': return read_string(s, pos)
+    elif c in _closers: raise Exception(_closers[c])
 
-def read_vector(reader):
-    return read_sequence(reader, _vector, '[', ']')
-
-def read_form(reader):
-    token = reader.peek()
     # reader macros/transforms
-    if token[0] == ';':
-        reader.next()
-        return None
-    elif token == '\'':
-        reader.next()
-        return _list(_symbol('quote'), read_form(reader))
-    elif token == '`':
-        reader.next()
-        return _list(_symbol('quasiquote'), read_form(reader))
-    elif token == '~':
-        reader.next()
-        return _list(_symbol('unquote'), read_form(reader))
-    elif token == '~@':
-        reader.next()
-        return _list(_symbol('splice-unquote'), read_form(reader))
-    elif token == '^':
-        reader.next()
-        meta = read_form(reader)
-        return _list(_symbol('with-meta'), read_form(reader), meta)
-    elif token == '@':
-        reader.next()
-        return _list(_symbol('deref'), read_form(reader))
-
-    # list
-    elif token == ')': raise Exception("unexpected ')'")
-    elif token == '(': return read_list(reader)
-
-    # vector
-    elif token == ']': raise Exception("unexpected ']'");
-    elif token == '[': return read_vector(reader);
-
-    # hash-map
-    elif token == '}': raise Exception("unexpected '}'");
-    elif token == '{': return read_hash_map(reader);
-
-    # atom
-    else:              return read_atom(reader);
+    elif c == '~' and s.startswith('~@', pos):
+        form, pos = read_form(s, pos + 2)
+        return _list(_symbol('splice-unquote'), form), pos
+    elif c in _quotes:
+        form, pos = read_form(s, pos + 1)
+        return _list(_symbol(_quotes[c]), form), pos
+    elif c == '^':
+        meta, pos = read_form(s, pos + 1)
+        form, pos = read_form(s, pos)
+        return _list(_symbol('with-meta'), form, meta), pos
 
 def read_str(str):
-    tokens = tokenize(str)
-    if len(tokens) == 0: raise Blank("Blank Line")
-    return read_form(Reader(tokens))
+    pos = _skip_re.match(str).end()
+    if pos == len(str): raise Blank("Blank Line")
+    return read_form(str, pos)[0]
 
 if __name__ == '__main__':
     x = read_str('(read-string "(1 2 (3 4) nil)")')
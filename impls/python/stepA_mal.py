@@ -1,10 +1,15 @@
 import functools
-import sys, traceback
+import os, sys, traceback
 import mal_readline
 import mal_types as types
+from mal_types import Symbol
 import reader, printer
 from env import Env
 import core
+import profiler
+import image
+import parallel
+import transpiler
 
 # read
 def READ(str):
@@ -39,12 +44,24 @@ def is_macro_call(ast, env):
             env.find(ast[0]) and
             hasattr(env.get(ast[0]), '_ismacro_'))
 
+# The expansion is stored on the call site and reused while ast[0] is
+# still bound to the same macro
 def macroexpand(ast, env):
     while is_macro_call(ast, env):
         mac = env.get(ast[0])
-        ast = mac(*ast[1:])
+        if hasattr(mac, '_impure_'):
+            ast = expand_macro(mac, ast[1:])
+            continue
+        cached = getattr(ast, '__expansion__', None)
+        if cached is None or cached[0] is not mac:
+            cached = ast.__expansion__ = (mac, expand_macro(mac, ast[1:]))
+        ast = cached[1]
     return ast
 
+def expand_macro(mac, args):
+    if profiler.enabled: return profiler.expand(mac, args)
+    return mac(*args)
+
 def eval_ast(ast, env):
     if types._symbol_Q(ast):
         return env.get(ast)
@@ -57,93 +74,169 @@ def eval_ast(ast, env):
     else:
         return ast  # primitive value, return unchanged
 
+# special forms: handlers return a value, or a TailCall to continue the
+# loop in EVAL with another ast and env
+
+class TailCall(object):
+    __slots__ = ('ast', 'env')
+    def __init__(self, ast, env):
+        self.ast = ast
+        self.env = env
+
+def eval_def(ast, env):
+    a1, a2 = ast[1], ast[2]
+    res = EVAL(a2, env)
+    if transpiler.threshold: transpiler.watch(res, a1, env)
+    return env.set(a1, profiler.name(res, a1))
+
+def eval_let(ast, env):
+    a1, a2 = ast[1], ast[2]
+    let_env = Env(env)
+    for i in range(0, len(a1), 2):
+        let_env.set(a1[i], EVAL(a1[i+1], let_env))
+    return TailCall(a2, let_env)
+
+def eval_quote(ast, env):
+    return ast[1]
+
+def eval_quasiquoteexpand(ast, env):
+    return quasiquote(ast[1])
+
+def eval_quasiquote(ast, env):
+    return TailCall(quasiquote(ast[1]), env)
+
+def eval_defmacro(ast, env):
+    func = types._macro(EVAL(ast[2], env))
+    return env.set(ast[1], profiler.name(func, ast[1]))
+
+def eval_macroexpand(ast, env):
+    return macroexpand(ast[1], env)
+
+def eval_py_exec(ast, env):
+    exec(compile(ast[1], '', 'single'), globals())
+    return None
+
+def eval_py_eval(ast, env):
+    return types.py_to_mal(eval(ast[1]))
+
+def eval_py_call(ast, env):
+    el = eval_ast(ast[2:], env)
+    f = eval(ast[1])
+    return f(*el)
+
+def eval_try(ast, env):
+    if len(ast) < 3:
+        return EVAL(ast[1], env)
+    a1, a2 = ast[1], ast[2]
+    if a2[0] == "catch*":
+        err = None
+        try:
+            return EVAL(a1, env)
+        except types.MalException as exc:
+            err = exc.object
+        except Exception as exc:
+            err = exc.args[0]
+        catch_env = Env(env, [a2[1]], [err])
+        return EVAL(a2[2], catch_env)
+    else:
+        return EVAL(a1, env);
+
+def eval_do(ast, env):
+    eval_ast(ast[1:-1], env)
+    return TailCall(ast[-1], env)
+
+def eval_if(ast, env):
+    cond = EVAL(ast[1], env)
+    if cond is None or cond is False:
+        return TailCall(ast[3] if len(ast) > 3 else None, env)
+    return TailCall(ast[2], env)
+
+def eval_fn(ast, env):
+    a1, a2 = ast[1], ast[2]
+    return types._function(EVAL, Env, a2, env, a1)
+
+# keyed by the interned symbols the reader returns, so that a lookup
+# mostly stops at identity
+special_forms = dict((types._symbol(k), v) for k, v in {
+    'def!':             eval_def,
+    'let*':             eval_let,
+    'quote':            eval_quote,
+    'quasiquoteexpand': eval_quasiquoteexpand,
+    'quasiquote':       eval_quasiquote,
+    'defmacro!':        eval_defmacro,
+    'macroexpand':      eval_macroexpand,
+    'py!*':             eval_py_exec,
+    'py*':              eval_py_eval,
+    '.':                eval_py_call,
+    'try*':             eval_try,
+    'do':               eval_do,
+    'if':               eval_if,
+    'fn*':              eval_fn}.items())
+
 def EVAL(ast, env):
-    while True:
-        #print("EVAL %s" % printer._pr_str(ast))
-        if not types._list_Q(ast):
-            return eval_ast(ast, env)
-
-        # apply list
-        ast = macroexpand(ast, env)
-        if not types._list_Q(ast):
-            return eval_ast(ast, env)
-        if len(ast) == 0: return ast
-        a0 = ast[0]
-
-        if "def!" == a0:
-            a1, a2 = ast[1], ast[2]
-            res = EVAL(a2, env)
-            return env.set(a1, res)
-        elif "let*" == a0:
-            a1, a2 = ast[1], ast[2]
-            let_env = Env(env)
-            for i in range(0, len(a1), 2):
-                let_env.set(a1[i], EVAL(a1[i+1], let_env))
-            ast = a2
-            env = let_env
-            # Continue loop (TCO)
-        elif "quote" == a0:
-            return ast[1]
-        elif "quasiquoteexpand" == a0:
-            return quasiquote(ast[1]);
-        elif "quasiquote" == a0:
-            ast = quasiquote(ast[1]);
-            # Continue loop (TCO)
-        elif 'defmacro!' == a0:
-            func = types._clone(EVAL(ast[2], env))
-            func._ismacro_ = True
-            return env.set(ast[1], func)
-        elif 'macroexpand' == a0:
-            return macroexpand(ast[1], env)
-        elif "py!*" == a0:
-            exec(compile(ast[1], '', 'single'), globals())
-            return None
-        elif "py*" == a0:
-            return types.py_to_mal(eval(ast[1]))
-        elif "." == a0:
-            el = eval_ast(ast[2:], env)
-            f = eval(ast[1])
-            return f(*el)
-        elif "try*" == a0:
-            if len(ast) < 3:
-                return EVAL(ast[1], env)
-            a1, a2 = ast[1], ast[2]
-            if a2[0] == "catch*":
-                err = None
-                try:
-                    return EVAL(a1, env)
-                except types.MalException as exc:
-                    err = exc.object
-                except Exception as exc:
-                    err = exc.args[0]
-                catch_env = Env(env, [a2[1]], [err])
-                return EVAL(a2[2], catch_env)
-            else:
-                return EVAL(a1, env);
-        elif "do" == a0:
-            eval_ast(ast[1:-1], env)
-            ast = ast[-1]
-            # Continue loop (TCO)
-        elif "if" == a0:
-            a1, a2 = ast[1], ast[2]
-            cond = EVAL(a1, env)
-            if cond is None or cond is False:
-                if len(ast) > 3: ast = ast[3]
-                else:            ast = None
-            else:
-                ast = a2
-            # Continue loop (TCO)
-        elif "fn*" == a0:
-            a1, a2 = ast[1], ast[2]
-            return types._function(EVAL, Env, a2, env, a1)
-        else:
-            el = eval_ast(ast, env)
-            f = el[0]
-            if hasattr(f, '__ast__'):
-                ast = f.__ast__
-                env = f.__gen_env__(el[1:])
+    # the profiler activation of the fn whose body this frame is running
+    profiled = False
+    try:
+        while True:
+            #print("EVAL %s" % printer._pr_str(ast))
+            if not types._list_Q(ast):
+                return eval_ast(ast, env)
+
+            # apply list
+            ast = macroexpand(ast, env)
+            if not types._list_Q(ast):
+                return eval_ast(ast, env)
+            if len(ast) == 0: return ast
+            a0 = ast[0]
+
+            form = special_forms.get(a0) if type(a0) is Symbol else None
+            if form is not None:
+                ret = form(ast, env)
+                if type(ret) is not TailCall: return ret
+                ast, env = ret.ast, ret.env
+                # Continue loop (TCO)
             else:
-                return f(*el[1:])
+                el = eval_ast(ast, env)
+                f = el[0]
+                if hasattr(f, '__ast__'):
+                    if profiler.enabled:
+                        if profiled: profiler.pop()
+                        profiled = profiler.push(f)
+                    ast = f.__ast__
+                    env = f.__gen_env__(el[1:])
+                else:
+                    return f(*el[1:])
+    finally:
+        if profiled: profiler.pop()
+
+# image.py rebuilds saved tree walker fns with this EVAL, and transpiler.py
+# compiles them from their ast
+image.EVAL = EVAL
+transpiler.EVAL = EVAL
+transpiler.quasiquote = quasiquote
+
+# MAL_EVAL=analyze replaces the tree walker with the closure-compiling
+# evaluator in analyzer.py
+if os.environ.get('MAL_EVAL') == 'analyze':
+    import analyzer
+    analyzer.quasiquote = quasiquote
+    EVAL = analyzer.EVAL
+# MAL_EVAL=vm compiles to bytecode for the stack machine in vm.py
+elif os.environ.get('MAL_EVAL') == 'vm':
+    import vm
+    vm.quasiquote = quasiquote
+    EVAL = vm.EVAL
+# the forms transpiler.py does not translate are run by the EVAL in use
+transpiler.INTERPRET = EVAL
+
+# Python's recursion limit, set here for every evaluator so that each one
+# nests at least MAL_DEPTH non-tail mal calls. A call nests up to 4 python
+# frames in the tree walker and 6 in analyzer.py (call site, fn, run, and the
+# body's if and call nodes); vm.py keeps mal calls on a stack of its own and
+# only nests python frames through builtins that call mal fns.
+MAL_DEPTH = 300
+FRAMES_PER_CALL = 6 if os.environ.get('MAL_EVAL') == 'analyze' else 4
+sys.setrecursionlimit(100 + MAL_DEPTH * FRAMES_PER_CALL)
 
 # print
 def PRINT(exp):
@@ -154,16 +247,37 @@ repl_env = Env()
 def REP(str):
     return PRINT(EVAL(READ(str), repl_env))
 
-# core.py: defined using python
-for k, v in core.ns.items(): repl_env.set(types._symbol(k), v)
-repl_env.set(types._symbol('eval'), lambda ast: EVAL(ast, repl_env))
-repl_env.set(types._symbol('*ARGV*'), types._list(*sys.argv[2:]))
+# saved in images by name, see image.py
+image.builtins = dict(core.ns)
+image.builtins['eval'] = lambda ast: EVAL(ast, repl_env)
+image.builtins['save-image'] = lambda path: image.save(path, repl_env)
+# channels and go blocks on an asyncio loop (python 3 only)
+if sys.hexversion > 0x3000000:
+    import aio
+    image.builtins.update(aio.ns)
+if os.environ.get('MAL_EVAL') == 'vm':
+    image.builtins['disassemble'] = lambda x: vm.disassemble(x, repl_env)
 
-# core.mal: defined using the language itself
-REP("(def! *host-language* \"python\")")
-REP("(def! not (fn* (a) (if a false true)))")
-REP("(def! load-file (fn* (f) (eval (read-string (str \"(do \" (slurp f) \"\nnil)\")))))")
-REP("(defmacro! cond (fn* (& xs) (if (> (count xs) 0) (list 'if (first xs) (if (> (count xs) 1) (nth xs 1) (throw \"odd number of forms to cond\")) (cons 'cond (rest (rest xs)))))))")
+if len(sys.argv) >= 3 and sys.argv[1] == '--image':
+    repl_env = image.load(sys.argv[2])
+    del sys.argv[1:3]
+else:
+    # core.py: defined using python
+    for k, v in image.builtins.items(): repl_env.set(types._symbol(k), v)
+
+    # core.mal: defined using the language itself
+    REP("(def! *host-language* \"python\")")
+    REP("(def! not (fn* (a) (if a false true)))")
+    REP("(def! load-file (fn* (f) (eval (read-file f))))")
+    REP("(defmacro! lazy-seq (fn* (& body) `(lazy-seq* (fn* () (do ~@body)))))")
+    REP("(defmacro! profile (fn* (& body) `(do (profile-start) (try* (let* [v (do ~@body)] (do (profile-stop) (profile-print) v)) (catch* e (do (profile-stop) (profile-print) (throw e)))))))")
+    REP("(defmacro! future (fn* (& body) `(future-call (fn* () (do ~@body)))))")
+    REP("(defmacro! pfuture (fn* (& body) `(pfuture-call (fn* () (do ~@body)))))")
+    if 'go*' in image.builtins:
+        REP("(defmacro! go (fn* (& body) `(go* (fn* () (do ~@body)))))")
+    REP("(defmacro! cond (fn* (& xs) (if (> (count xs) 0) (list 'if (first xs) (if (> (count xs) 1) (nth xs 1) (throw \"odd number of forms to cond\")) (cons 'cond (rest (rest xs)))))))")
+repl_env.set(types._symbol('*ARGV*'), types._list(*sys.argv[2:]))
+parallel.repl_env = repl_env
 
 if len(sys.argv) >= 2:
     REP('(load-file "' + sys.argv[1] + '")')
@@ -0,0 +1,66 @@
+# Futures and promises on threads, for I/O bound work.
+#
+#   (future body...)        ; runs body on a pool thread; deref waits for it
+#   (def! p (promise))      ; deref waits until (deliver p value)
+#   (deref f 100 :timeout)  ; or @f, with a timeout in ms
+#
+# Futures share a ThreadPoolExecutor of MAL_THREADS (default 32) threads.
+# Mal code on several threads only runs one at a time, as python does, so
+# this helps where they wait on files or pipes; see parallel.py for
+# running mal code on several cores. Atoms are safe to share between
+# them: swap! retries when another thread changed the atom meanwhile.
+
+import os, threading
+try:
+    from concurrent.futures import ThreadPoolExecutor, TimeoutError
+except ImportError:
+    ThreadPoolExecutor = None
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(int(os.environ.get('MAL_THREADS') or 32))
+    return _pool
+
+class Future(object):
+    def __init__(self, f):
+        if ThreadPoolExecutor is None:
+            self._future, self._value = None, f()
+        else:
+            self._future = _get_pool().submit(f)
+    def realized(self):
+        return self._future is None or self._future.done()
+    def deref(self, timeout_ms=None, timeout_val=None):
+        if self._future is None: return self._value
+        try:
+            return self._future.result(None if timeout_ms is None
+                                       else timeout_ms / 1000.0)
+        except TimeoutError:
+            return timeout_val
+
+class Promise(object):
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._value = None
+    def realized(self): return self._event.is_set()
+    # only the first delivery counts: returns the promise, or nil after
+    def deliver(self, val):
+        with self._lock:
+            if self._event.is_set(): return None
+            self._value = val
+            self._event.set()
+        return self
+    def deref(self, timeout_ms=None, timeout_val=None):
+        if not self._event.wait(None if timeout_ms is None
+                                else timeout_ms / 1000.0):
+            return timeout_val
+        return self._value
+
+def future_call(f): return Future(f)
+def promise(): return Promise()
+def deliver(p, val): return p.deliver(val)
@@ -0,0 +1,478 @@
+# Compiles mal fns to python functions.
+#
+#   (def! fib (compile-fn fib))     ; fib as python code
+#   (compile-threshold 1000)        ; or MAL_COMPILE_THRESHOLD=1000: compile
+#                                   ; def!'d fns on their 1000th call
+#
+# The fn* body is translated to python source and built with compile():
+# let* bindings become python locals, if/do statements, self tail calls
+# a while loop, and calls of +, -, *, <, <=, >, >=, = and nil? python
+# operators. Globals are copied to the closure of the compiled function
+# and copied again once their env's version changes; when that finds one
+# the code depends on rebound (an operator, or the fn itself for the
+# loop) the compiled function hands its calls to the original fn. Forms
+# that are not translated (fn*, macroexpand, py*, . and impure macros)
+# become a fn of the current locals, made once by the evaluator in use
+# (the tree walker, analyzer or vm), which the code calls; a fn with
+# def! or defmacro! in its body is not compiled at all and compile-fn
+# returns it unchanged.
+#
+# Calls out of compiled code are python calls. Self tail calls are a
+# loop and tail calls between compiled fns are trampolined, so those run
+# in constant stack; a tail call to an interpreted fn does not.
+# Compiled functions are not seen by the profiler. Needs python 3
+# (nonlocal).
+
+import os, re
+import mal_types as types
+from mal_types import List, Vector, Hash_Map, MalException
+import image
+
+# set by stepA_mal: the tree walker (whose fns are compiled from their
+# ast), and the EVAL in use, for the forms not translated
+EVAL = None
+INTERPRET = None
+quasiquote = None
+
+threshold = int(os.environ.get('MAL_COMPILE_THRESHOLD') or 0)
+
+class Uncompilable(Exception): pass
+
+# (builtin name, argument count) -> python expression while the name is
+# bound to that builtin
+_OPERATORS = {
+    ('+', 2):    '(%s + %s)',
+    ('-', 2):    '(%s - %s)',
+    ('-', 1):    '(-%s)',
+    ('*', 2):    '(%s * %s)',
+    ('<', 2):    '(%s < %s)',
+    ('<=', 2):   '(%s <= %s)',
+    ('>', 2):    '(%s > %s)',
+    ('>=', 2):   '(%s >= %s)',
+    ('=', 2):    '_equal(%s, %s)',
+    ('nil?', 1): '(%s is None)',
+}
+
+_UNCOMPILABLE = frozenset(['def!', 'defmacro!'])
+_INTERPRETED = frozenset(['fn*', 'macroexpand', 'py!*', 'py*', '.'])
+
+_simple = re.compile(r'^(-?\d+|[A-Za-z_]\w*)$').match
+
+def _symbols_in(ast):
+    if types._symbol_Q(ast): yield ast
+    elif types._sequential_Q(ast):
+        for x in ast:
+            for s in _symbols_in(x): yield s
+    elif types._hash_map_Q(ast):
+        for x in ast.values():
+            for s in _symbols_in(x): yield s
+
+def _cells(f):
+    return dict(zip(f.__code__.co_freevars,
+                    (c.cell_contents for c in f.__closure__)))
+
+class Compiler(object):
+    def __init__(self, f):
+        cells = _cells(f)
+        self.orig = f
+        if cells['Eval'] is EVAL:
+            self.params, self.body = f.__params__, cells['ast']
+            self.cenv = f.__env__
+            self.frame = self.outer = None
+            genv = self.cenv
+            while genv.outer: genv = genv.outer
+        else:
+            ast, genv, self.outer = image._evaluator().sources[cells['ast']]
+            self.params, self.body = ast[1], ast[2]
+            self.cenv, self.frame = genv, f.__env__
+        self.genv = genv
+        self.name = getattr(f, '__malname__', None)
+        self.consts = []
+        self.globals = {}      # symbol -> python name
+        self.assumed = {}      # symbol -> the value the code relies on
+        self.pending = set()   # let* names a closure would see bound later
+        self.booleans = set()  # expressions known to be True or False
+        self.trampoline = False
+        self.count = 0
+
+    def fresh(self, prefix):
+        self.count += 1
+        return '%s%d' % (prefix, self.count)
+
+    def const(self, value):
+        for i, c in enumerate(self.consts):
+            if c is value: return 'k%d' % i
+        self.consts.append(value)
+        return 'k%d' % (len(self.consts) - 1)
+
+    def literal(self, value):
+        if value is None or value is True or value is False or type(value) == int:
+            return repr(value)
+        return self.const(value)
+
+    # a symbol bound outside the fn: a global, an enclosing tree walker
+    # env read on each use, or a slot of the analyzer's defining frame
+    def free(self, sym):
+        if self.outer is not None:
+            import analyzer
+            local = analyzer.resolve(self.outer, sym)
+            if local:
+                depth, slot = local
+                return self.const(self.frame) + '[0]' * depth + '[%d]' % slot
+        holder = self.cenv.find(sym)
+        if holder is None: raise Uncompilable("'%s' not found" % sym)
+        if holder is not self.genv:
+            return '%s[%s]' % (self.const(holder.data), self.const(sym))
+        name = self.globals.get(sym)
+        if name is None: name = self.globals[sym] = 'g%d' % len(self.globals)
+        return name
+
+    def global_value(self, sym, scope):
+        if sym in scope: return None
+        if self.outer is not None:
+            import analyzer
+            if analyzer.resolve(self.outer, sym): return None
+        holder = self.cenv.find(sym)
+        if holder is not self.genv: return None
+        return holder.data[sym]
+
+    def is_self(self, sym, scope):
+        return (self.name is not None and sym == self.name and
+                self.global_value(sym, scope) is self.orig)
+
+    # Expressions: returns python source for the value of ast, adding
+    # the statements it needs first to out as (indent, line)
+
+    def expr(self, ast, scope, out, ind):
+        if types._symbol_Q(ast):
+            return scope.get(ast) or self.free(ast)
+        elif types._list_Q(ast):
+            if len(ast) == 0: return self.const(ast)
+            return self.form(ast, scope, out, ind, False)
+        elif types._vector_Q(ast):
+            return '_Vector([%s])' % ', '.join(self.exprs(ast, scope, out, ind))
+        elif types._hash_map_Q(ast):
+            keys = list(ast.keys())
+            vals = self.exprs([ast[k] for k in keys], scope, out, ind)
+            return '_Hash_Map((%s))' % ''.join(
+                '(%s, %s), ' % (self.const(k), v) for k, v in zip(keys, vals))
+        else:
+            return self.literal(ast)
+
+    # in order: an earlier value is kept in a temporary when a later one
+    # needs statements
+    def exprs(self, asts, scope, out, ind):
+        parts = []
+        for a in asts:
+            pre = []
+            e = self.expr(a, scope, pre, ind)
+            if pre:
+                for i, p in enumerate(parts):
+                    if not _simple(p):
+                        t = self.fresh('t')
+                        out.append((ind, '%s = %s' % (t, p)))
+                        parts[i] = t
+                out.extend(pre)
+            parts.append(e)
+        return parts
+
+    # python source that is true when ast's value is neither nil nor false
+    def test(self, ast, scope, out, ind):
+        e = self.expr(ast, scope, out, ind)
+        if e in self.booleans: return e
+        if not _simple(e):
+            t = self.fresh('t')
+            out.append((ind, '%s = %s' % (t, e)))
+            e = t
+        return '(%s is not None and %s is not False)' % (e, e)
+
+    # Tail position: statements that return the value of ast, or go round
+    # the loop again for a self tail call
+    def tail(self, ast, scope, out, ind):
+        if types._list_Q(ast) and len(ast) > 0:
+            e = self.form(ast, scope, out, ind, True)
+            if e is None: return
+        else:
+            e = self.expr(ast, scope, out, ind)
+        out.append((ind, 'return ' + e))
+
+    # A list form; in tail position returns None once it has emitted its
+    # own returns
+    def form(self, ast, scope, out, ind, tail):
+        a0 = ast[0]
+        if types._symbol_Q(a0):
+            if a0 in _UNCOMPILABLE: raise Uncompilable(a0)
+            if a0 in _INTERPRETED: return self.interpreted(ast, scope, out, ind)
+            handler = getattr(self, 'form_' + _FORMS.get(a0, 'none'), None)
+            if handler is not None: return handler(ast, scope, out, ind, tail)
+            value = self.global_value(a0, scope)
+            if hasattr(value, '_ismacro_'):
+                if hasattr(value, '_impure_'):
+                    return self.interpreted(ast, scope, out, ind)
+                self.free(a0)
+                self.assumed[a0] = value
+                # the expansion the evaluators cached on the call site
+                cached = getattr(ast, '__expansion__', None)
+                if cached is None or cached[0] is not value:
+                    cached = ast.__expansion__ = (value, value(*ast[1:]))
+                expansion = cached[1]
+                if tail:
+                    self.tail(expansion, scope, out, ind)
+                    return None
+                return self.expr(expansion, scope, out, ind)
+            if self.is_self(a0, scope):
+                return self.self_call(ast, scope, out, ind, tail)
+            op = _OPERATORS.get((a0, len(ast) - 1))
+            if op is not None and value is image.builtins.get(a0):
+                self.free(a0)
+                self.assumed[a0] = value
+                e = op % tuple(self.exprs(ast[1:], scope, out, ind))
+                if a0 not in ('+', '-', '*'): self.booleans.add(e)
+                return e
+        parts = self.exprs(ast, scope, out, ind)
+        call = '%s(%s)' % (parts[0], ', '.join(parts[1:]))
+        if not tail or self.is_builtin(a0, scope): return call
+        # another compiled fn runs its body in the caller's loop
+        self.trampoline = True
+        b = self.fresh('b')
+        out.append((ind, '%s = getattr(%s, "__tail__", None)' % (b, parts[0])))
+        out.append((ind, 'if %s is not None: return _Tail(%s, (%s))' % (
+            b, b, ''.join(p + ', ' for p in parts[1:]))))
+        return call
+
+    def is_builtin(self, sym, scope):
+        if not types._symbol_Q(sym): return False
+        value = self.global_value(sym, scope)
+        return any(value is v for v in image.builtins.values())
+
+    def self_call(self, ast, scope, out, ind, tail):
+        self.free(ast[0])
+        self.assumed[ast[0]] = self.orig
+        args = self.exprs(ast[1:], scope, out, ind)
+        if not tail: return '_self(%s)' % ', '.join(args)
+        names, nfixed = self.param_names, self.nfixed
+        if len(args) < nfixed: raise Uncompilable("arity")
+        values = args[:nfixed]
+        if len(names) > nfixed: values.append('_List([%s])' % ', '.join(args[nfixed:]))
+        elif len(args) > nfixed: raise Uncompilable("arity")
+        if names:
+            out.append((ind, '%s, = %s,' % (', '.join(names), ', '.join(values))))
+        out.append((ind, 'continue'))
+        return None
+
+    def form_if(self, ast, scope, out, ind, tail):
+        cond = self.test(ast[1], scope, out, ind)
+        a3 = ast[3] if len(ast) > 3 else None
+        if tail:
+            out.append((ind, 'if %s:' % cond))
+            self.tail(ast[2], scope, out, ind + 1)
+            out.append((ind, 'else:'))
+            self.tail(a3, scope, out, ind + 1)
+            return None
+        then, other = [], []
+        e1 = self.expr(ast[2], scope, then, ind + 1)
+        e2 = self.expr(a3, scope, other, ind + 1)
+        if not then and not other:
+            return '(%s if %s else %s)' % (e1, cond, e2)
+        t = self.fresh('t')
+        out.append((ind, 'if %s:' % cond))
+        out.extend(then)
+        out.append((ind + 1, '%s = %s' % (t, e1)))
+        out.append((ind, 'else:'))
+        out.extend(other)
+        out.append((ind + 1, '%s = %s' % (t, e2)))
+        return t
+
+    def form_let(self, ast, scope, out, ind, tail):
+        a1 = ast[1]
+        scope = dict(scope)
+        pending = self.pending
+        for i in range(0, len(a1), 2):
+            self.pending = pending | set(a1[i::2])
+            e = self.expr(a1[i+1], scope, out, ind)
+            name = self.fresh('v')
+            out.append((ind, '%s = %s' % (name, e)))
+            scope[a1[i]] = name
+        self.pending = pending
+        return self.form_body(ast[2], scope, out, ind, tail)
+
+    def form_do(self, ast, scope, out, ind, tail):
+        for a in ast[1:-1]:
+            e = self.expr(a, scope, out, ind)
+            if not _simple(e): out.append((ind, e))
+        return self.form_body(ast[-1], scope, out, ind, tail)
+
+    def form_body(self, ast, scope, out, ind, tail):
+        if tail:
+            self.tail(ast, scope, out, ind)
+            return None
+        return self.expr(ast, scope, out, ind)
+
+    def form_quote(self, ast, scope, out, ind, tail):
+        return self.literal(ast[1])
+
+    def form_quasiquoteexpand(self, ast, scope, out, ind, tail):
+        return self.const(quasiquote(ast[1]))
+
+    def form_quasiquote(self, ast, scope, out, ind, tail):
+        return self.form_body(quasiquote(ast[1]), scope, out, ind, tail)
+
+    def form_try(self, ast, scope, out, ind, tail):
+        if len(ast) < 3 or ast[2][0] != 'catch*':
+            return self.expr(ast[1], scope, out, ind)
+        a2 = ast[2]
+        t, exc, err = self.fresh('t'), self.fresh('x'), self.fresh('v')
+        out.append((ind, 'try:'))
+        body = []
+        e = self.expr(ast[1], scope, body, ind + 1)
+        out.extend(body)
+        out.append((ind + 1, '%s = %s' % (t, e)))
+        out.append((ind, 'except Exception as %s:' % exc))
+        out.append((ind + 1, '%s = %s.object if isinstance(%s, _MalException) '
+                    'else %s.args[0]' % (err, exc, exc, exc)))
+        catch_scope = dict(scope)
+        catch_scope[a2[1]] = err
+        e = self.expr(a2[2], catch_scope, out, ind + 1)
+        out.append((ind + 1, '%s = %s' % (t, e)))
+        return t
+
+    # A call of (fn* [locals] ast), evaluated once, now, by INTERPRET
+    def interpreted(self, ast, scope, out, ind):
+        if self.pending & set(_symbols_in(ast)):
+            raise Uncompilable("closure over a let* binding being defined")
+        if self.outer is not None and _outer_names(self.outer):
+            raise Uncompilable("interpreted form in a nested fn")
+        syms = list(scope.keys())
+        f = INTERPRET(List([types._symbol('fn*'), List(syms), ast]), self.cenv)
+        return '%s(%s)' % (self.const(f), ', '.join(scope[s] for s in syms))
+
+    def source(self):
+        params, names, scope = self.params, [], {}
+        self.nfixed = len(params)
+        sig = []
+        for i, p in enumerate(params):
+            if p == '&':
+                self.nfixed = i
+                name = scope[params[i+1]] = self.fresh('v')
+                names.append(name)
+                sig.append('*' + name)
+                break
+            name = scope[p] = self.fresh('v')
+            names.append(name)
+            sig.append(name)
+        self.param_names = names
+        body = []
+        self.tail(self.body, scope, body, 3)
+        for sym in self.globals: self.const(sym)
+        for value in self.assumed.values(): self.const(value)
+
+        lines = ['def _make(_G, _orig, _consts, _List, _Vector, '
+                 '_Hash_Map, _MalException, _equal, _Tail):']
+        if self.consts:
+            lines.append('    %s, = _consts' % ', '.join(
+                'k%d' % i for i in range(len(self.consts))))
+        gnames = sorted(self.globals.values())
+        if gnames: lines.append('    %s = None' % ' = '.join(gnames))
+        lines.append('    _ver = None')
+        lines.append('    def _refresh():')
+        lines.append('        nonlocal %s' % ', '.join(['_ver'] + gnames))
+        lines.append('        _d = _G.data')
+        for sym, name in sorted(self.globals.items(), key=lambda kv: kv[1]):
+            lines.append('        %s = _d[%s]' % (name, self.const(sym)))
+            if sym in self.assumed and self.assumed[sym] is self.orig:
+                lines.append('        if %s is _orig: %s = _self' % (name, name))
+                lines.append('        elif %s is not _self: return False' % name)
+            elif sym in self.assumed:
+                lines.append('        if %s is not %s: return False'
+                             % (name, self.const(self.assumed[sym])))
+        lines.append('        _ver = _G.version')
+        lines.append('        return True')
+        # with tail calls to other fns, _body may return a _Tail to run
+        # instead, which _self does
+        if self.trampoline:
+            lines.append('    def _self(*args):')
+            lines.append('        r = _body(*args)')
+            lines.append('        while type(r) is _Tail: r = r.fn(*r.args)')
+            lines.append('        return r')
+        body_name = '_body' if self.trampoline else '_self'
+        lines.append('    def %s(%s):' % (body_name, ', '.join(sig)))
+        if len(names) > self.nfixed:
+            lines.append('        %s = _List(%s)' % (names[-1], names[-1]))
+        lines.append('        while True:')
+        call = ', '.join(names[:self.nfixed] +
+                         ['*' + n for n in names[self.nfixed:]])
+        lines.append('            if _G.version != _ver and not _refresh():')
+        lines.append('                return _orig(%s)' % call)
+        lines.extend('    ' * i + line for i, line in body)
+        lines.append('    return _self, %s' % body_name)
+        return '\n'.join(lines) + '\n'
+
+    def build(self):
+        src = self.source()
+        code = compile(src, '<compiled %s>' % (self.name or 'fn'), 'exec')
+        ns = {}
+        exec(code, ns)
+        fn, body = ns['_make'](self.genv, self.orig, tuple(self.consts),
+                               List, Vector, Hash_Map, MalException,
+                               types._equal_Q, _Tail)
+        fn.__tail__ = body
+        fn.__meta__ = getattr(self.orig, '__meta__', None)
+        if self.name is not None: fn.__malname__ = self.name
+        fn.__compiled_from__ = self.orig
+        fn.__source__ = src
+        return fn
+
+class _Tail(object):
+    __slots__ = ('fn', 'args')
+    def __init__(self, fn, args):
+        self.fn = fn
+        self.args = args
+
+def _outer_names(scope):
+    while scope:
+        if scope.names: return True
+        scope = scope.outer
+    return False
+
+_FORMS = {
+    'if':               'if',
+    'let*':             'let',
+    'do':               'do',
+    'quote':            'quote',
+    'quasiquoteexpand': 'quasiquoteexpand',
+    'quasiquote':       'quasiquote',
+    'try*':             'try',
+}
+
+def compile_fn(f):
+    if not hasattr(f, '__ast__') or getattr(f, '__code__', None) is not image._FN_CODE:
+        return f
+    try:
+        return Compiler(f).build()
+    except Exception:
+        return f
+
+# Auto-compilation: a def!'d global fn counts its calls in the env
+# builder of its closure (see _function), and is compiled and rebound on
+# reaching the threshold
+def watch(f, sym, env):
+    if (env.outer is not None or not hasattr(f, '__ast__') or
+            getattr(f, '__code__', None) is not image._FN_CODE):
+        return
+    cell = f.__closure__[image._FN_CODE.co_freevars.index('gen_env')]
+    build = cell.cell_contents
+    calls = [0]
+    def counting(args):
+        calls[0] += 1
+        if threshold and calls[0] >= threshold:
+            cell.cell_contents = f.__gen_env__ = build
+            compiled = compile_fn(f)
+            if compiled is not f and env.data.get(sym) is f:
+                env.set(sym, compiled)
+        return build(args)
+    cell.cell_contents = f.__gen_env__ = counting
+
+def compile_threshold(n=None):
+    global threshold
+    threshold = n or 0
+    return n
@@ -0,0 +1,515 @@
+import weakref
+import profiler
+import transpiler
+import printer
+import mal_types as types
+from mal_types import Hash_Map, MalException
+from analyzer import Layout, Scope, Frames, resolve, macroexpand, expand_macro
+
+# Bytecode evaluator: each form is compiled once into a list of (op, arg)
+# instructions for a stack machine, run by the loop in run. Enabled in
+# stepA_mal with MAL_EVAL=vm; (disassemble f) shows the code of a fn.
+#
+# Locals live in frames laid out as in analyzer.py: a python list whose
+# slot 0 is the enclosing frame, with let* and catch* slots in the frame
+# of the enclosing fn*. A call of a mal fn from bytecode does not call
+# python: run saves the caller's (ops, pc, frame, stack) and continues
+# with the callee, so non-tail recursion is only limited by memory.
+# Builtins that call mal fns (map, apply, swap!, ...) still go through
+# python, running the fn in a nested run.
+#
+# Macro calls are expanded at compile time. A SITE instruction in front
+# of the expansion checks that the macro was not redefined and otherwise
+# runs a sub-code compiled from the new expansion; calls to globals that
+# are not defined yet get a SITE that compiles them again on first
+# execution, in case they name a macro defined later. Sub-codes run in
+# the frame of the code they replace, or in one of their own for impure
+# macros, which are expanded on every execution.
+
+# set by stepA_mal
+quasiquote = None
+
+(CONST, LOAD_LOCAL, LOAD_OUTER, LOAD_GLOBAL, STORE_LOCAL, STORE_LOCAL_EXT,
+ POP, CALL, TAILCALL, RETURN, JUMP, JUMP_IF_FALSE, MAKE_CLOSURE, TRY,
+ END_TRY, DEF_GLOBAL, DEF_MACRO, SITE) = range(18)
+
+OPNAMES = ('CONST', 'LOAD_LOCAL', 'LOAD_OUTER', 'LOAD_GLOBAL', 'STORE_LOCAL',
+           'STORE_LOCAL_EXT', 'POP', 'CALL', 'TAILCALL', 'RETURN', 'JUMP',
+           'JUMP_IF_FALSE', 'MAKE_CLOSURE', 'TRY', 'END_TRY', 'DEF_GLOBAL',
+           'DEF_MACRO', 'SITE')
+
+# Instruction arguments:
+#   CONST value, LOAD_LOCAL slot, LOAD_OUTER (depth, slot),
+#   LOAD_GLOBAL [env, symbol, cached value, env.version when cached],
+#   STORE_LOCAL(_EXT) slot (pops), CALL/TAILCALL argument count,
+#   JUMP/JUMP_IF_FALSE target pc, MAKE_CLOSURE Proto, TRY pc of the catch
+#   (which starts with the error pushed), DEF_GLOBAL/DEF_MACRO (env, symbol)
+#   (keep the value), SITE Site.
+
+class Code(object):
+    __slots__ = ('ops', 'name', 'frame_size', '__weakref__')
+    def __init__(self, ops, name, frame_size=0):
+        self.ops = ops
+        self.name = name
+        self.frame_size = frame_size   # run in a new frame of this size
+
+# The fn* form, global env and enclosing scope of each compiled fn body,
+# so that image.py can compile the closures it restores again
+sources = weakref.WeakKeyDictionary()
+
+# A compiled fn* form, made into a fn by MAKE_CLOSURE
+class Proto(object):
+    def __init__(self, ast, env, scope):
+        params = ast[1]
+        self.params = params
+        self.layout = layout = Layout()
+        self.scope = scope = Scope(scope, layout)
+        nfixed, variadic = len(params), False
+        for i, p in enumerate(params):
+            if p == "&":
+                nfixed, variadic = i, True
+                scope.bind(params[i+1])
+                break
+            scope.bind(p)
+        self.code = compile_code(ast[2], env, scope, printer._pr_str(ast))
+        layout.frozen = True
+        self.frames = Frames(layout, nfixed, variadic)
+        sources[self.code] = (ast, env, scope.outer)
+
+    def make(self, frame):
+        return types._function(run, self.frames, self.code, frame,
+                               self.params)
+
+# for image.py, like analyzer.analyze_fn
+def analyze_fn(ast, env, scope, tail):
+    proto = Proto(ast, env, scope)
+    return proto.make
+
+# A macro call, or a call of a global not defined at compile time. run
+# takes the inline code after the SITE while code is None and version is
+# env.version; otherwise alternative() tells it what to run instead.
+class Site(object):
+    def __init__(self, kind, ast, env, scope, mac):
+        # 'macro', 'impure' or 'deferred', which becomes 'call' or 'sub'
+        self.kind = kind
+        self.ast = ast
+        self.env = env
+        self.scope = scope
+        self.mac = mac
+        self.version = env.version if kind == 'macro' else -1
+        self.code = None
+        self.end = None      # pc after the inline code
+
+    def sub(self, ast, scope):
+        name = printer._pr_str(self.ast)
+        if self.kind == 'impure':
+            layout = Layout()
+            inner = Scope(scope if scope.outer else None, layout)
+            code = compile_code(ast, self.env, inner, name)
+            layout.frozen = True
+            code.frame_size = layout.size
+            return code
+        return compile_code(ast, self.env, scope, name)
+
+    def alternative(self):
+        env, ast = self.env, self.ast
+        if self.kind == 'impure':
+            return self.sub(macroexpand(ast, env), self.scope)
+        if self.kind == 'deferred':
+            mac = env.find(ast[0]) and env.get(ast[0])
+            if hasattr(mac, '_ismacro_') or hasattr(mac, '_impure_'):
+                self.kind = 'sub'
+                self.code = self.sub(ast, self.scope)
+            else:
+                self.kind = 'call'
+        if self.kind != 'macro':
+            self.version = env.version
+            return self.code
+        if self.version != env.version:
+            self.version = env.version
+            if self.kind == 'macro':
+                mac = env.find(ast[0]) and env.get(ast[0])
+                if mac is not self.mac:
+                    self.mac = mac
+                    self.code = self.sub(ast, self.scope)
+        return self.code
+
+# Globals whose def! value is being compiled: calls to them are usually
+# recursion, not a macro defined later.
+defining = []
+
+class Compiler(object):
+    def __init__(self, env):
+        self.env = env
+        self.ops = []
+
+    def emit(self, op, arg=None):
+        self.ops.append((op, arg))
+        return len(self.ops) - 1
+
+    def patch(self, at, arg):
+        self.ops[at] = (self.ops[at][0], arg)
+
+    def ret(self, tail):
+        if tail: self.emit(RETURN)
+
+    def store(self, scope, slot):
+        self.emit(STORE_LOCAL_EXT if scope.layout.frozen else STORE_LOCAL, slot)
+
+    def comp(self, ast, scope, tail):
+        if types._symbol_Q(ast):
+            local = resolve(scope, ast)
+            if not local:
+                self.emit(LOAD_GLOBAL, [self.env, ast, None, -1])
+            elif local[0] == 0:
+                self.emit(LOAD_LOCAL, local[1])
+            else:
+                self.emit(LOAD_OUTER, local)
+            self.ret(tail)
+        elif types._list_Q(ast):
+            if len(ast) == 0:
+                self.emit(CONST, ast)
+                return self.ret(tail)
+            a0 = ast[0]
+            if types._symbol_Q(a0):
+                if a0 in special_forms:
+                    return special_forms[a0](self, ast, scope, tail)
+                if not resolve(scope, a0) and a0 not in defining:
+                    env = self.env
+                    if not env.find(a0):
+                        return self.site(Site('deferred', ast, env, scope, None),
+                                         lambda: self.apply(ast, scope, tail), tail)
+                    mac = env.get(a0)
+                    if hasattr(mac, '_impure_'):
+                        return self.site(Site('impure', ast, env, scope, mac),
+                                         lambda: None, tail)
+                    if hasattr(mac, '_ismacro_'):
+                        ast.__expansion__ = (mac, expand_macro(mac, ast[1:]))
+                        expansion = ast.__expansion__[1]
+                        return self.site(Site('macro', ast, env, scope, mac),
+                                         lambda: self.comp(expansion, scope, tail), tail)
+            self.apply(ast, scope, tail)
+        elif types._vector_Q(ast):
+            self.emit(CONST, types._vector)
+            for a in ast: self.comp(a, scope, False)
+            self.emit(CALL, len(ast))
+            self.ret(tail)
+        elif types._hash_map_Q(ast):
+            keys = list(ast.keys())
+            self.emit(CONST, lambda *vals: Hash_Map(zip(keys, vals)))
+            for k in keys: self.comp(ast[k], scope, False)
+            self.emit(CALL, len(keys))
+            self.ret(tail)
+        else:
+            self.emit(CONST, ast)
+            self.ret(tail)
+
+    # inline() compiles what runs while the site needs nothing else; an
+    # impure site has no inline code and returns its sub-code's value
+    def site(self, site, inline, tail):
+        site.tail = tail
+        self.emit(SITE, site)
+        inline()
+        site.end = len(self.ops)
+        if site.kind == 'impure': self.ret(tail)
+
+    def apply(self, ast, scope, tail):
+        for a in ast: self.comp(a, scope, False)
+        self.emit(TAILCALL if tail else CALL, len(ast) - 1)
+
+    # a python function called with the values of args
+    def call_python(self, f, args, scope, tail):
+        self.emit(CONST, f)
+        for a in args: self.comp(a, scope, False)
+        self.emit(CALL, len(args))
+        self.ret(tail)
+
+# special forms
+
+def comp_def(c, ast, scope, tail):
+    a1 = ast[1]
+    if scope.outer is None:
+        defining.append(a1)
+        try:
+            c.comp(ast[2], scope, False)
+        finally:
+            defining.pop()
+        c.emit(DEF_GLOBAL, (c.env, a1))
+        return c.ret(tail)
+    c.comp(ast[2], scope, False)
+    # like the tree walker, def! inside fn*/let* binds in the innermost block
+    slot = scope.names.get(a1) or scope.bind(a1)
+    c.store(scope, slot)
+    c.emit(LOAD_LOCAL, slot)
+    c.ret(tail)
+
+def comp_let(c, ast, scope, tail):
+    a1 = ast[1]
+    scope = Scope(scope, scope.layout)
+    for sym in a1[::2]:
+        if sym not in scope.names: scope.bind(sym)
+    for i in range(0, len(a1), 2):
+        pending = frozenset(a1[i::2]) - frozenset(a1[:i:2])
+        init_scope = Scope(scope.outer, scope.layout, scope.names, pending)
+        c.comp(a1[i+1], init_scope, False)
+        c.store(scope, scope.names[a1[i]])
+    c.comp(ast[2], scope, tail)
+
+def comp_quote(c, ast, scope, tail):
+    c.emit(CONST, ast[1])
+    c.ret(tail)
+
+def comp_quasiquoteexpand(c, ast, scope, tail):
+    c.emit(CONST, quasiquote(ast[1]))
+    c.ret(tail)
+
+def comp_quasiquote(c, ast, scope, tail):
+    c.comp(quasiquote(ast[1]), scope, tail)
+
+def comp_defmacro(c, ast, scope, tail):
+    c.comp(ast[2], scope, False)
+    c.emit(DEF_MACRO, (c.env, ast[1]))
+    c.ret(tail)
+
+def comp_macroexpand(c, ast, scope, tail):
+    a1, env = ast[1], c.env
+    c.call_python(lambda: macroexpand(a1, env), [], scope, tail)
+
+def comp_py_exec(c, ast, scope, tail):
+    code = compile(ast[1], '', 'single')
+    def py_exec():
+        exec(code, globals())
+        return None
+    c.call_python(py_exec, [], scope, tail)
+
+def comp_py_eval(c, ast, scope, tail):
+    code = compile(ast[1], '', 'eval')
+    c.call_python(lambda: types.py_to_mal(eval(code)), [], scope, tail)
+
+def comp_py_call(c, ast, scope, tail):
+    code = compile(ast[1], '', 'eval')
+    c.call_python(lambda *args: eval(code)(*args), ast[2:], scope, tail)
+
+def comp_try(c, ast, scope, tail):
+    if len(ast) < 3:
+        return c.comp(ast[1], scope, tail)
+    a1, a2 = ast[1], ast[2]
+    if a2[0] != "catch*":
+        return c.comp(a1, scope, tail)
+    at = c.emit(TRY)
+    c.comp(a1, scope, False)
+    c.emit(END_TRY)
+    if tail: c.emit(RETURN)
+    else:    jump = c.emit(JUMP)
+    c.patch(at, len(c.ops))
+    scope = Scope(scope, scope.layout)
+    c.store(scope, scope.bind(a2[1]))
+    c.comp(a2[2], scope, tail)
+    if not tail: c.patch(jump, len(c.ops))
+
+def comp_do(c, ast, scope, tail):
+    if len(ast) == 1:
+        c.emit(CONST, None)
+        return c.ret(tail)
+    for a in ast[1:-1]:
+        c.comp(a, scope, False)
+        c.emit(POP)
+    c.comp(ast[-1], scope, tail)
+
+def comp_if(c, ast, scope, tail):
+    c.comp(ast[1], scope, False)
+    at = c.emit(JUMP_IF_FALSE)
+    c.comp(ast[2], scope, tail)
+    if not tail: jump = c.emit(JUMP)
+    c.patch(at, len(c.ops))
+    if len(ast) > 3: c.comp(ast[3], scope, tail)
+    else:
+        c.emit(CONST, None)
+        c.ret(tail)
+    if not tail: c.patch(jump, len(c.ops))
+
+def comp_fn(c, ast, scope, tail):
+    c.emit(MAKE_CLOSURE, Proto(ast, c.env, scope))
+    c.ret(tail)
+
+special_forms = {
+    'def!':             comp_def,
+    'let*':             comp_let,
+    'quote':            comp_quote,
+    'quasiquoteexpand': comp_quasiquoteexpand,
+    'quasiquote':       comp_quasiquote,
+    'defmacro!':        comp_defmacro,
+    'macroexpand':      comp_macroexpand,
+    'py!*':             comp_py_exec,
+    'py*':              comp_py_eval,
+    '.':                comp_py_call,
+    'try*':             comp_try,
+    'do':               comp_do,
+    'if':               comp_if,
+    'fn*':              comp_fn}
+
+# A code whose value is the value of ast
+def compile_code(ast, env, scope, name):
+    c = Compiler(env)
+    c.comp(ast, scope, True)
+    return Code(c.ops, name)
+
+def EVAL(ast, env):
+    layout = Layout()
+    code = compile_code(ast, env, Scope(None, layout), 'top level')
+    layout.frozen = True
+    return run(code, [env] + [None] * (layout.size - 1))
+
+# The loop. An activation is the code, pc, frame and value stack of one
+# fn call (or sub-code); calls holds the suspended ones with whether the
+# profiler has an activation for them. A TRY handler is (catch pc, number
+# of suspended activations, stack depth) of the activation that ran it.
+def run(code, frame):
+    ops, pc, stack = code.ops, 0, []
+    calls, handlers = [], []
+    prof = False
+    while True:
+        try:
+            while True:
+                op, arg = ops[pc]
+                pc += 1
+                if op == LOAD_LOCAL:
+                    stack.append(frame[arg])
+                elif op == LOAD_GLOBAL:
+                    env = arg[0]
+                    if arg[3] != env.version:
+                        arg[2] = env.get(arg[1])
+                        arg[3] = env.version
+                    stack.append(arg[2])
+                elif op == CONST:
+                    stack.append(arg)
+                elif op == CALL:
+                    if arg:
+                        args = stack[-arg:]
+                        del stack[-arg:]
+                    else:
+                        args = ()
+                    f = stack.pop()
+                    body = getattr(f, '__ast__', None)
+                    if type(body) is Code:
+                        calls.append((ops, pc, frame, stack, prof))
+                        frame = f.__gen_env__(args)
+                        ops, pc, stack = body.ops, 0, []
+                        prof = profiler.enabled and profiler.push(f)
+                    else:
+                        stack.append(f(*args))
+                elif op == JUMP_IF_FALSE:
+                    cond = stack.pop()
+                    if cond is None or cond is False: pc = arg
+                elif op == RETURN or op == TAILCALL:
+                    if op == TAILCALL:
+                        if arg:
+                            args = stack[-arg:]
+                            del stack[-arg:]
+                        else:
+                            args = ()
+                        f = stack.pop()
+                        body = getattr(f, '__ast__', None)
+                        if type(body) is Code:
+                            frame = f.__gen_env__(args)
+                            ops, pc, stack = body.ops, 0, []
+                            if profiler.enabled:
+                                if prof: profiler.pop()
+                                prof = profiler.push(f)
+                            continue
+                        value = f(*args)
+                    else:
+                        value = stack[-1]
+                    if prof: profiler.pop()
+                    if not calls: return value
+                    ops, pc, frame, stack, prof = calls.pop()
+                    stack.append(value)
+                elif op == STORE_LOCAL:
+                    frame[arg] = stack.pop()
+                elif op == JUMP:
+                    pc = arg
+                elif op == POP:
+                    stack.pop()
+                elif op == LOAD_OUTER:
+                    outer = frame
+                    for _ in range(arg[0]): outer = outer[0]
+                    stack.append(outer[arg[1]])
+                elif op == SITE:
+                    if arg.code is None and arg.version == arg.env.version:
+                        continue
+                    sub = arg.alternative()
+                    if sub is None: continue
+                    if not arg.tail:
+                        calls.append((ops, arg.end, frame, stack, prof))
+                        prof = False
+                    if sub.frame_size:
+                        frame = [frame] + [None] * (sub.frame_size - 1)
+                    ops, pc, stack = sub.ops, 0, []
+                elif op == MAKE_CLOSURE:
+                    stack.append(arg.make(frame))
+                elif op == STORE_LOCAL_EXT:
+                    if arg >= len(frame): frame.extend([None] * (arg + 1 - len(frame)))
+                    frame[arg] = stack.pop()
+                elif op == TRY:
+                    handlers.append((arg, len(calls), len(stack)))
+                elif op == END_TRY:
+                    handlers.pop()
+                elif op == DEF_GLOBAL:
+                    env, sym = arg
+                    value = stack[-1]
+                    if transpiler.threshold: transpiler.watch(value, sym, env)
+                    env.set(sym, profiler.name(value, sym))
+                elif op == DEF_MACRO:
+                    env, sym = arg
+                    stack[-1] = types._macro(stack[-1])
+                    env.set(sym, profiler.name(stack[-1], sym))
+                else:
+                    raise Exception("bad opcode %r" % op)
+        except Exception as exc:
+            if not handlers:
+                if prof: profiler.pop()
+                for call in reversed(calls):
+                    if call[4]: profiler.pop()
+                raise
+            catch, ncalls, depth = handlers.pop()
+            while len(calls) > ncalls:
+                if prof: profiler.pop()
+                ops, pc, frame, stack, prof = calls.pop()
+            if isinstance(exc, MalException): err = exc.object
+            else:                             err = exc.args[0]
+            del stack[depth:]
+            stack.append(err)
+            pc = catch
+
+# Disassembler
+
+def _arg(op, arg):
+    if op == LOAD_GLOBAL:                         return str(arg[1])
+    if op in (DEF_GLOBAL, DEF_MACRO):             return str(arg[1])
+    if op == LOAD_OUTER:                          return 'depth %d slot %d' % arg
+    if op in (JUMP, JUMP_IF_FALSE, TRY):          return '-> %d' % arg
+    if op == MAKE_CLOSURE:                        return arg.code.name
+    if op == SITE:
+        return '%s %s, inline to %d' % (arg.kind, printer._pr_str(arg.ast), arg.end)
+    if op == CONST:                               return printer._pr_str(arg)
+    if arg is None:                               return ''
+    return str(arg)
+
+def disassemble_code(code):
+    lines, nested = [code.name], []
+    for pc, (op, arg) in enumerate(code.ops):
+        lines.append(('%5d  %-16s%s' % (pc, OPNAMES[op], _arg(op, arg))).rstrip())
+        if op == MAKE_CLOSURE: nested.append(arg.code)
+        elif op == SITE and arg.code is not None: nested.append(arg.code)
+    for c in nested:
+        lines.append('')
+        lines.append(disassemble_code(c))
+    return '\n'.join(lines)
+
+# (disassemble f) for a fn, or (disassemble 'form) for the code of a form
+def disassemble(x, env):
+    body = getattr(x, '__ast__', None)
+    if type(body) is not Code:
+        if callable(x): raise MalException("disassemble: not a compiled fn")
+        body = compile_code(x, env, Scope(None, Layout()), 'top level')
+    return disassemble_code(body)
@@ -167,6 +167,7 @@ class TestReader:
         self.form = None
         self.out = ""
         self.ret = None
+        self.requires = False
 
         while self.data:
             self.line_num += 1
@@ -189,6 +190,11 @@ class TestReader:
                 if 'optional' in settings and settings['optional']:
                     self.optional = "\nSkipping optional tests"
                     return True
+                # the tests up to the next requires setting are skipped
+                # unless this form evaluates to true (None: run them all)
+                if 'requires' in settings:
+                    self.requires = settings['requires']
+                    return True
                 continue
             elif line[0:1] == ";":         # unexpected comment
                 raise Exception("Test data error at line %d:\n%s" % (self.line_num, line))
@@ -262,11 +268,23 @@ test_cnt = 0
 pass_cnt = 0
 fail_cnt = 0
 soft_fail_cnt = 0
+skip_cnt = 0
 failures = []
+skipping = False
 
 class TestTimeout(Exception):
     pass
 
+# Whether form evaluates to true
+def check_requires(form):
+    r.writeline(form)
+    res = r.read_to_prompt(['\r\n[^\s()<>]+> ', '\n[^\s()<>]+> '],
+                            timeout=args.test_timeout)
+    if res == None:
+        log("\nException: TIMEOUT checking requires=%s" % repr(form))
+        sys.exit(1)
+    return re.search("%strue\\s*$" % sep, res) != None
+
 while t.next():
     if args.deferrable == False and t.deferrable:
         log(t.deferrable)
@@ -276,12 +294,22 @@ while t.next():
         log(t.optional)
         break
 
+    if t.requires != False:
+        skipping = t.requires != None and not check_requires(t.requires)
+        if skipping: log("\nSkipping tests that require %s" % t.requires)
+        continue
+
     if t.msg != None:
         log(t.msg)
         continue
 
     if t.form == None: continue
 
+    if skipping:
+        log("TEST: %s -> [%s,%s] -> SKIPPED" % (repr(t.form), repr(t.out), t.ret))
+        skip_cnt += 1
+        continue
+
     log("TEST: %s -> [%s,%s]" % (repr(t.form), repr(t.out), t.ret), end='')
 
     # The repeated form is to get around an occasional OS X issue
@@ -338,9 +366,10 @@ TEST RESULTS (for %s):
   %3d: soft failing tests
   %3d: failing tests
   %3d: passing tests
+  %3d: skipped tests
   %3d: total tests
 """ % (args.test_file, soft_fail_cnt, fail_cnt,
-        pass_cnt, test_cnt)
+        pass_cnt, skip_cnt, test_cnt)
 log(results)
 
 debug("\n") # add some separate to debug log